@@ -0,0 +1,248 @@
+#!/usr/local/bin/python3
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import argparse, os, sys, time, threading, random, itertools, json, csv, statistics, subprocess, platform
+from btcp import checksum
+from btcp.btcp_segment import BTCPSegment
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.lossy_layer import LossyLayer, probe_payload_size
+from btcp.emulator import EmulatedNetwork
+from btcp.constants import *
+
+# Run `func` on every item of `items` for `repeat` rounds, and return the best time per item in microseconds
+def time_per_item(func, items, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items) * 1e6
+
+# Compare the checksum backends on random segments of SEGMENT_SIZE bytes
+def bench_checksum(args):
+    segments = [os.urandom(SEGMENT_SIZE) for _ in range(args.segments)]
+    results = {}
+    for name, func in checksum.BACKENDS.items():
+        results[name] = time_per_item(func, segments, args.repeat)
+
+    # The batch API checksums all segments in a single call
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        checksum.checksum_batch(segments)
+        best = min(best, time.perf_counter() - start)
+    results["numpy batch"] = best / len(segments) * 1e6
+
+    print(f"Checksum over {args.segments} segments of {SEGMENT_SIZE} bytes, best of {args.repeat}:")
+    for name, usec in results.items():
+        speedup = results["python"] / usec
+        print(f"  {name:<12} {usec:8.2f} us/segment  {speedup:6.1f}x")
+
+# Measure how many segments per second can be packed and unpacked
+def bench_segment(args):
+    payloads = [os.urandom(PAYLOAD_SIZE) for _ in range(args.segments)]
+    segments = [BTCPSegment(i, i + 1, 100, payload) for i, payload in enumerate(payloads)]
+    packed = [segment.pack() for segment in segments]
+    # A send buffer with a slot for every segment, like the one of the client
+    buffer = bytearray(len(segments) * SEGMENT_SIZE)
+    offsets = range(0, len(buffer), SEGMENT_SIZE)
+    results = {
+        "construct + pack": time_per_item(lambda payload: BTCPSegment(1, 2, 100, payload).pack(), payloads, args.repeat),
+        "pack": time_per_item(lambda segment: segment.pack(), segments, args.repeat),
+        "pack_all_into": time_per_item(lambda segments: BTCPSegment.pack_all_into(segments, offsets, buffer), [segments], args.repeat) / len(segments),
+        "unpack": time_per_item(BTCPSegment.unpack, packed, args.repeat),
+    }
+    print(f"Segments of {SEGMENT_SIZE} bytes, best of {args.repeat}:")
+    for name, usec in results.items():
+        print(f"  {name:<16} {usec:8.2f} us/segment  {1e6 / usec:12,.0f} segments/s")
+
+# Impairment profiles for the sweep, as netem rules applied by the in-process emulator.
+# These are the scenarios of testframework.py. The "udp" profile uses the real LossyLayer over loopback instead.
+PROFILES = {
+    "udp": None,
+    "ideal": "",
+    "corrupt": "corrupt 1%",
+    "duplicate": "duplicate 10%",
+    "lossy": "loss 10% 25%",
+    "reorder": "delay 20ms reorder 25% 50%",
+    "delayed": "delay 100ms 20ms",
+    "allbad": "corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%",
+}
+
+# Transfer `data` from a client to a server socket, and return measurements of the transfer
+def transfer(data, window = 100, timeout = 300, payload_size = PAYLOAD_SIZE, lossy_layer = LossyLayer):
+    server = BTCPServerSocket(window, timeout, False, lossy_layer=lossy_layer, payload_size=payload_size)
+    server.listen()
+    client = BTCPClientSocket(window, timeout, False, 20, lossy_layer=lossy_layer, payload_size=payload_size)
+    client.connect()
+    received = bytearray()
+    # The final ACK of the handshake may be lost, in which case the connection is only accepted once data arrives
+    def receive():
+        connection = server.accept()
+        while True:
+            chunk = connection.recv(1 << 20)
+            if not chunk:
+                break
+            received.extend(chunk)
+    thread = threading.Thread(target=receive)
+    before = client.stats()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    thread.start()
+    client.send(data)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    n_segments = client.n_segments
+    after = client.stats()
+    segments = after["segments_sent"] - before["segments_sent"]
+    client.disconnect()
+    client.close()
+    server.close()
+    if received != data:
+        raise RuntimeError(f"Transfer of {len(data)} bytes was corrupted")
+    return {
+        "seconds": elapsed,
+        "goodput": len(data) / elapsed,
+        "segments_sent": segments,
+        "bytes_sent": after["bytes_sent"] - before["bytes_sent"],
+        "retransmissions_timeout": after["retransmissions_timeout"] - before["retransmissions_timeout"],
+        "retransmissions_fast": after["retransmissions_fast"] - before["retransmissions_fast"],
+        # Fraction of the data segments that was sent more than once
+        "retransmission_overhead": segments / n_segments - 1,
+        # CPU time of the whole process, so of both the client and the server
+        "cpu_per_mb": cpu / (len(data) / 1e6) if data else 0,
+    }
+
+# Measure the throughput of a loopback transfer for a range of payload sizes
+def bench_throughput(args):
+    sizes = args.sizes or [PAYLOAD_SIZE, 4096, 8192, 16384, 32768, probe_payload_size(SERVER_IP)]
+    data = os.urandom(args.bytes)
+    print(f"Transfer of {args.bytes} bytes with window {args.window}, best of {args.repeat}:")
+    for size in sizes:
+        elapsed = min(transfer(data, args.window, payload_size=size)["seconds"] for _ in range(args.repeat))
+        print(f"  {size:>6} byte payloads  {elapsed:8.3f} s  {args.bytes / elapsed / 1e6:8.1f} MB/s")
+
+# Load an input, which is either a file or a size of synthetic data such as 10M, returned as (name, data)
+def load_input(name, seed):
+    if os.path.exists(name):
+        with open(name, "rb") as f:
+            return os.path.basename(name), f.read()
+    units = {"k": 1e3, "M": 1e6, "G": 1e9}
+    size = int(float(name[:-1]) * units[name[-1]]) if name[-1] in units else int(name)
+    return name, random.Random(seed).randbytes(size)
+
+# The commit the benchmark runs on, if known, such that results can be compared across commits
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run transfers for every combination of input, window, timeout and impairment profile
+def bench_sweep(args):
+    results = []
+    meta = {"commit": git_commit(), "python": platform.python_version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": args.seed, "repeat": args.repeat}
+    inputs = [load_input(name, args.seed) for name in args.inputs]
+    for (name, data), window, timeout, profile in itertools.product(inputs, args.windows, args.timeouts, args.profiles):
+        # Profiles that are not predefined are taken to be netem rules
+        rule = PROFILES.get(profile, profile)
+        for run in range(args.repeat):
+            if rule is None:
+                result = transfer(data, window, timeout)
+            else:
+                network = EmulatedNetwork(rule, seed=args.seed + run)
+                try:
+                    result = transfer(data, window, timeout, lossy_layer=network.layer)
+                finally:
+                    network.close()
+            result = {"input": name, "bytes": len(data), "window": window, "timeout": timeout, "profile": profile,
+                      "run": run, **result}
+            results.append(result)
+            print(f"{name:>16} w={window:<4} t={timeout:<5} {profile:>10} #{run}  {result['seconds']:8.3f} s  "
+                  f"{result['goodput'] / 1e6:7.2f} MB/s  {result['retransmission_overhead']:6.1%} retransmitted  "
+                  f"{result['cpu_per_mb']:6.3f} CPU s/MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(meta) + list(results[0]))
+            writer.writeheader()
+            for result in results:
+                writer.writerow({**meta, **result})
+
+# Median completion time per configuration of the sweep results in a JSON file
+def load_sweep(path):
+    with open(path) as f:
+        results = json.load(f)["results"]
+    configurations = {}
+    for result in results:
+        key = (result["input"], result["window"], result["timeout"], result["profile"])
+        configurations.setdefault(key, []).append(result["seconds"])
+    return {key: statistics.median(seconds) for key, seconds in configurations.items()}
+
+# Compare two sweeps, and fail if any configuration became more than `threshold` percent slower
+def bench_compare(args):
+    baseline, current = load_sweep(args.baseline), load_sweep(args.current)
+    regressions = 0
+    for key in sorted(baseline.keys() & current.keys()):
+        change = current[key] / baseline[key] - 1
+        regression = change * 100 > args.threshold
+        regressions += regression
+        name, window, timeout, profile = key
+        print(f"{name:>16} w={window:<4} t={timeout:<5} {profile:>10}  {baseline[key]:8.3f} s -> {current[key]:8.3f} s  "
+              f"{change:+7.1%}{'  REGRESSION' if regression else ''}")
+    if regressions:
+        sys.exit(f"{regressions} configuration(s) regressed by more than {args.threshold}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="bTCP micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_checksum = subparsers.add_parser("checksum", help="Compare the checksum backends")
+    parser_checksum.add_argument("-n", "--segments", help="Number of segments to checksum", type=int, default=1000)
+    parser_checksum.add_argument("-r", "--repeat", help="Number of rounds, the best is reported", type=int, default=5)
+    parser_checksum.set_defaults(func=bench_checksum)
+
+    parser_segment = subparsers.add_parser("segment", help="Measure packing and unpacking of segments")
+    parser_segment.add_argument("-n", "--segments", help="Number of segments", type=int, default=1000)
+    parser_segment.add_argument("-r", "--repeat", help="Number of rounds, the best is reported", type=int, default=5)
+    parser_segment.set_defaults(func=bench_segment)
+
+    parser_throughput = subparsers.add_parser("throughput", help="Measure loopback throughput against the payload size")
+    parser_throughput.add_argument("-s", "--sizes", help="Payload sizes to measure, by default up to the probed maximum", type=int, nargs="*")
+    parser_throughput.add_argument("-b", "--bytes", help="Number of bytes to transfer", type=int, default=10_000_000)
+    parser_throughput.add_argument("-w", "--window", help="Window size in segments", type=int, default=100)
+    parser_throughput.add_argument("-r", "--repeat", help="Number of rounds, the best is reported", type=int, default=3)
+    parser_throughput.set_defaults(func=bench_throughput)
+
+    parser_sweep = subparsers.add_parser("sweep", help="Measure transfers over a range of parameters and network conditions")
+    parser_sweep.add_argument("-i", "--inputs", help="Files to send, or sizes of synthetic data such as 10M", nargs="+", default=["input.file", "10M"])
+    parser_sweep.add_argument("-w", "--windows", help="Window sizes in segments", type=int, nargs="+", default=[100])
+    parser_sweep.add_argument("-t", "--timeouts", help="Initial retransmission timeouts in milliseconds", type=int, nargs="+", default=[300])
+    parser_sweep.add_argument("-p", "--profiles", help=f"Network conditions, one of {sorted(PROFILES)} or a netem rule", nargs="+", default=["udp", "ideal"])
+    parser_sweep.add_argument("-r", "--repeat", help="Number of runs per configuration", type=int, default=3)
+    parser_sweep.add_argument("-s", "--seed", help="Seed of the synthetic data and the emulated network", type=int, default=0)
+    parser_sweep.add_argument("-o", "--output", help="JSON file to write the results to", default=None)
+    parser_sweep.add_argument("--csv", help="CSV file to write the results to", default=None)
+    parser_sweep.set_defaults(func=bench_sweep)
+
+    parser_compare = subparsers.add_parser("compare", help="Compare the results of two sweeps, e.g. of two commits")
+    parser_compare.add_argument("baseline", help="JSON results of the baseline")
+    parser_compare.add_argument("current", help="JSON results to compare against the baseline")
+    parser_compare.add_argument("--threshold", help="Percentage by which a configuration may become slower", type=float, default=10)
+    parser_compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+main()
@@ -0,0 +1,250 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import asyncio, socket, time
+from btcp.constants import *
+from btcp.btcp_segment import SYNSegment, FINSegment
+from btcp.sequence import seq_add
+from btcp.client_socket import BTCPClientSocket, SYN_TIMER, FIN_TIMER
+from btcp.server_socket import BTCPServerSocket, BTCPServerConnection
+from btcp.file_io import mapped_file, PreallocatedFile
+
+# asyncio counterparts of BTCPClientSocket and BTCPServerSocket.
+# Rather than a thread per socket, segments are received by a datagram endpoint on the running event loop,
+# and timers are loop callbacks, such that many connections can be driven from a single loop.
+# The protocol logic itself is shared with the threaded sockets.
+
+
+# Drop-in replacement for the LossyLayer, which delivers incoming segments from the event loop
+class DatagramLayer(asyncio.DatagramProtocol):
+    def __init__(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
+        self._bTCP_sock = bTCP_sock
+        self._a_addr = (a_ip, a_port)
+        self._b_addr = (b_ip, b_port)
+        self._transport = None
+        self._closed = None
+
+    # Create the datagram endpoint on the running loop, if that did not happen yet
+    async def open(self):
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp_sock.bind(self._a_addr)
+            self._closed = loop.create_future()
+            self._transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=udp_sock)
+
+    def datagram_received(self, data, addr):
+        self._bTCP_sock.lossy_layer_input((data, addr))
+
+    def connection_lost(self, exc):
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+
+    # Close the endpoint. This does not block, use wait_closed to wait until the socket is released.
+    def destroy(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def wait_closed(self):
+        if self._closed is not None:
+            await self._closed
+
+    # Put the segment into the network, addressed to b unless another address is given
+    def send_segment(self, segment, address = None):
+        self._transport.sendto(segment, address or self._b_addr)
+
+    # The transport has no batched send, so send the segments one by one
+    def send_segments(self, segments, address = None):
+        for segment in segments:
+            self._transport.sendto(segment, address or self._b_addr)
+
+
+# Lets coroutines wait for incoming segments. self._input_event is set whenever a segment has been processed.
+class AsyncWaiter:
+    # Sleep until a segment has been processed, or until `timeout` seconds have passed
+    async def wait_for_input(self, timeout = None):
+        self._input_event.clear()
+        handle = None
+        if timeout is not None:
+            handle = asyncio.get_running_loop().call_later(max(timeout, 0), self._input_event.set)
+        await self._input_event.wait()
+        if handle is not None:
+            handle.cancel()
+
+    # Wait until `predicate()` holds, re-evaluating it after every processed segment.
+    # Returns whether it holds, which is False only if `timeout` seconds have passed.
+    async def wait_until(self, predicate, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            if deadline is None:
+                await self.wait_for_input()
+            elif time.time() >= deadline:
+                return False
+            else:
+                await self.wait_for_input(deadline - time.time())
+        return True
+
+
+# Shared by the asyncio sockets: wake up waiting coroutines whenever a segment has been processed
+class AsyncBTCPSocket(AsyncWaiter):
+    def lossy_layer_input(self, segment, verified = False):
+        super().lossy_layer_input(segment, verified)
+        self._input_event.set()
+
+    # Clean up any state, and wait until the UDP socket is released
+    async def close(self):
+        super().close()
+        await self._lossy_layer.wait_closed()
+
+
+class AsyncBTCPClientSocket(AsyncBTCPSocket, BTCPClientSocket):
+    def __init__(self, window, timeout, debug, retries, sack = True, congestion_control = "cubic",
+                 local_addr = (CLIENT_IP, CLIENT_PORT), remote_addr = (SERVER_IP, SERVER_PORT), varlen = True,
+                 payload_size = PAYLOAD_SIZE):
+        self._input_event = asyncio.Event()
+        super().__init__(window, timeout, debug, retries, sack, congestion_control,
+                         lambda bTCP_sock, *_: DatagramLayer(bTCP_sock, *local_addr, *remote_addr), varlen, payload_size)
+
+    # Perform a three-way handshake to establish a connection
+    async def connect(self):
+        await self._lossy_layer.open()
+        # Set state to "SYN sent, waiting on SYNACK"
+        self.state = 1
+        # Retransmissions of the SYN use the same sequence number
+        segment = SYNSegment(self._window, self.sack, self.varlen, self.max_payload_size)
+        self.x.append(seq_add(segment.seq_n, 1))
+        # Send at most self.retries connection attempts until we are connected.
+        # If afterward we still aren't connected, reset
+        if not await self.send_until(SYN_TIMER, segment.pack(), self._connection_event.is_set):
+            await self.close()
+            raise Exception("Could not connect to Server.")
+
+    # Send data originating from the application in a reliable way to the server.
+    async def send(self, source):
+        # If the state is "Connected"
+        if self.state == 2:
+            self.start_sending(source)
+            # Loop until self.last_acked is -1, which only occurs when the very last segment is ACKed
+            while self.last_acked != -1:
+                with self.mutex:
+                    deadline = self.pump()
+                if self.last_acked == -1:
+                    break
+                await self.wait_for_input(None if deadline is None else deadline - time.time())
+        else:
+            await self.close()
+            raise Exception("Not Connected to Server, cannot send")
+
+    # Send the file at `path`, with the same semantics as BTCPClientSocket.send_file
+    async def send_file(self, path):
+        with mapped_file(path) as source:
+            try:
+                await self.send(source)
+            finally:
+                self.payloads = None
+
+    # Send the packed control segment `segment` until `done()` holds, with the same semantics as BTCPClientSocket.send_until
+    async def send_until(self, key, segment, done):
+        tries = 0
+        while not done() and tries < self.retries:
+            self.send_segment(segment)
+            tries += 1
+            self.timers.arm(key, time.time())
+            await self.wait_until(done, self.timers.remaining(key, time.time(), self._timeout / 1000))
+        self.timers.cancel(key)
+        return done()
+
+    # Perform a handshake to terminate a connection
+    async def disconnect(self):
+        # Only disconnect if not already disconnected
+        if self._state != 0:
+            self.state = 3
+            segment = FINSegment(0, self._window)
+            # Send at most self.retries disconnection attempts until we are disconnected.
+            await self.send_until(FIN_TIMER, self.pack(segment), lambda: not self._connection_event.is_set())
+            # Reset to default state regardless of server response
+            self.state = 0
+            self._connection_event.clear()
+
+
+# A connection of an AsyncBTCPServerSocket, which is woken up by segments from its own client only
+class AsyncBTCPServerConnection(AsyncWaiter, BTCPServerConnection):
+    def __init__(self, server, address):
+        self._input_event = asyncio.Event()
+        super().__init__(server, address)
+
+    def handle_segment(self, *args):
+        super().handle_segment(*args)
+        self._input_event.set()
+
+    # Wait for incoming data, with the same semantics as BTCPServerConnection.recv
+    async def recv(self, max_bytes = None, timeout = None):
+        if not await self.wait_until(lambda: self.buffer or self.eof, timeout):
+            raise TimeoutError("No data received within the timeout")
+        return super().recv(max_bytes, 0)
+
+    # Wait for incoming data, with the same semantics as BTCPServerConnection.recv_into
+    async def recv_into(self, buffer, nbytes = 0, timeout = None):
+        if not await self.wait_until(lambda: self.buffer or self.eof, timeout):
+            raise TimeoutError("No data received within the timeout")
+        return super().recv_into(buffer, nbytes, 0)
+
+    # Write all data from the client to the file at `path`, with the same semantics as BTCPServerConnection.recv_file
+    async def recv_file(self, path, chunk_size = FILE_CHUNK_SIZE, timeout = None):
+        with PreallocatedFile(path, chunk_size) as f:
+            n = None
+            while n != 0:
+                with f.next_chunk() as view:
+                    filled = 0
+                    while filled < len(view):
+                        n = await self.recv_into(view[filled:], timeout=timeout)
+                        if n == 0:
+                            break
+                        filled += n
+                        f.size += n
+        return f.size
+
+    def close(self):
+        super().close()
+        self._input_event.set()
+
+
+class AsyncBTCPServerSocket(AsyncBTCPSocket, BTCPServerSocket):
+    connection_class = AsyncBTCPServerConnection
+
+    def __init__(self, window, timeout, debug, sack = True, local_addr = (SERVER_IP, SERVER_PORT), varlen = True,
+                 payload_size = PAYLOAD_SIZE, ack_every = DELAYED_ACK_SEGMENTS, ack_delay = DELAYED_ACK_TIMEOUT):
+        self._input_event = asyncio.Event()
+        super().__init__(window, timeout, debug, sack,
+                         lambda bTCP_sock, *_: DatagramLayer(bTCP_sock, *local_addr, CLIENT_IP, CLIENT_PORT), varlen, payload_size,
+                         ack_every, ack_delay)
+        # Handles of the callbacks that send delayed ACKs, by connection
+        self.ack_handles = {}
+
+    # Delayed ACKs are sent from a callback on the event loop, rather than from a timer thread
+    def start_ack_timer(self, connection):
+        if connection not in self.ack_handles:
+            self.ack_handles[connection] = asyncio.get_running_loop().call_later(
+                self.ack_delay / 1000, self.send_delayed_ack, connection)
+
+    def send_delayed_ack(self, connection):
+        del self.ack_handles[connection]
+        if connection.unacked and not self.closed:
+            connection.send_ack()
+
+    # Start accepting connection requests from clients
+    async def listen(self):
+        await self._lossy_layer.open()
+        super().listen()
+
+    # Wait for a client to complete a three-way handshake, and return the new connection
+    async def accept(self, timeout = None):
+        if self.state != 1:
+            await self.listen()
+        if not await self.wait_until(lambda: not self.accepted.empty(), timeout):
+            raise TimeoutError("No connection accepted within the timeout")
+        return self.accepted.get_nowait()
@@ -4,142 +4,144 @@
 # ------------------------
 
 import struct, random
-import numpy as np
+from btcp import checksum
+from btcp.constants import *
+from btcp.sequence import SEQUENCE_SPACE
+
+# The header: seq_n, ack_n, flags, window, data_length and checksum
+HEADER = struct.Struct("!HHBBHH")
+CHECKSUM = struct.Struct("!H")
+SACK_BLOCK = struct.Struct("!HH")
+# The body of a SYN or SYNACK holds the payload size option
+PAYLOAD_SIZE_OPTION = struct.Struct("!H")
+# Used to pad segments with zeroes without allocating
+ZEROES = memoryview(bytes(MAX_SEGMENT_SIZE))
 
 class BTCPSegment:
-    def __init__(self, seq_n: int, ack_n: int, window: int, data: bytes):
-        super().__init__()
+    # Segments are created for every segment that is sent, so they are kept small
+    __slots__ = ("seq_n", "ack_n", "flags", "window", "data_length", "data")
+
+    def __init__(self, seq_n: int, ack_n: int, window: int, data: bytes, flags: int = 0):
         self.seq_n = seq_n
         self.ack_n = ack_n
-        self.flags = {
-            "ACK": 0,
-            "SYN": 0,
-            "FIN": 0
-        }
-        self.byte_flags = self.convert_flags_to_int()
-        self.window = window
-        self.data_length = len(data)
-        self.data = data
-
-    def convert_flags_to_int(self):
-        # ACK SYN FIN
-        # So, ACK SYN is
-        # 0000 0110
-        # and FIN is
-        # 0000 0001
-        val = 0
-        if self.flags["ACK"]:
-            val += 4
-        if self.flags["SYN"]:
-            val += 2
-        if self.flags["FIN"]:
-            val += 1
-        return val
-
-    @staticmethod
-    def convert_int_to_flags(val: int) -> set:
-        # ACK SYN FIN
+        # Bitmask of FLAG_SACK, FLAG_ACK, FLAG_SYN and FLAG_FIN
         # So, ACK SYN is
         # 0000 0110
         # and FIN is
         # 0000 0001
-        flags = set()
-        if val >= 4:
-            val -= 4
-            flags.add("ACK")
-        if val >= 2:
-            val -= 2
-            flags.add("SYN")
-        if val >= 1:
-            val -= 1
-            flags.add("FIN")
-        return flags
+        self.flags = flags
+        self.window = window
+        self.data_length = len(data)
+        self.data = data
 
     @staticmethod
     def get_checksum(packet):
-        # Round down to nearest multiple of 2
-        n = (len(packet) // 2) * 2
-        checksum = 0
-
-        # Range from 0 to count with steps of 2 
-        for i in range(0, n, 2):
-            checksum += packet[i + 1] * 256 + packet[i]
-            checksum &= 0xffffffff
-
-        # If len(packet) is not a multiple of two, add the final packet
-        if n < len(packet):
-            checksum += packet[-1]
-            checksum &= 0xffffffff
-
-        # Remove overflow
-        checksum = (checksum >> 16) + (checksum & 0xffff)
-        checksum += (checksum >> 16)
-        # Flip and remove overflow
-        out = ~checksum
-        out &= 0xffff
-        out = out >> 8 | (out << 8 & 0xff00)
-        return out
-
-    def _pack(self, checksum = 0):
-        # Place all values with the given checksum in a struct of the right format
-        return struct.pack("!HHBBHH1008s", self.seq_n, 
-                                     self.ack_n, 
-                                     self.byte_flags, 
-                                     self.window,
-                                     self.data_length,
-                                     checksum,
-                                     self.data)
-    
-    def pack(self):
-        # Get the segment with an empty checksum
-        data = self._pack()
-        # Get the checksum over this segment
-        checksum = self.get_checksum(data)
-        # And get the segment with the actual checksum value filled in.
-        return self._pack(checksum)
+        # Delegate to the selected checksum backend, see btcp/checksum.py
+        return checksum.get_checksum(packet)
+
+    # The length of the packed segment. Segments are padded to `segment_size`, the negotiated payload size
+    # plus the header, unless `varlen` was negotiated. As padding consists of zeroes, it does not affect the checksum.
+    def size(self, varlen = False, segment_size = SEGMENT_SIZE):
+        return HEADER_SIZE + len(self.data) if varlen else segment_size
+
+    def pack(self, varlen = False, segment_size = SEGMENT_SIZE):
+        # Pack the segment into a new buffer, with the checksum filled in
+        buffer = bytearray(self.size(varlen, segment_size))
+        self.pack_into(buffer, 0, varlen=varlen, segment_size=segment_size)
+        CHECKSUM.pack_into(buffer, CHECKSUM_OFFSET, self.get_checksum(buffer))
+        return buffer
 
     @staticmethod
     def unpack(data):
-        # Unpack a segment using the format
-        return struct.unpack("!HHBBHH1008s", data)
+        # Unpack the header of a segment, and return its fields followed by the body.
+        # The body is a memoryview into `data`, so it is not copied.
+        return HEADER.unpack_from(data) + (memoryview(data)[HEADER_SIZE:],)
+
+    def pack_into(self, buffer, offset, checksum = 0, varlen = False, segment_size = SEGMENT_SIZE):
+        # Place all values with the given checksum directly into `buffer` at `offset`.
+        # The data is copied in separately, as it may be any bytes-like object.
+        HEADER.pack_into(buffer, offset, self.seq_n, self.ack_n, self.flags, self.window, self.data_length, checksum)
+        start = offset + HEADER_SIZE
+        end = start + len(self.data)
+        buffer[start:end] = self.data
+        # Pad with zeroes, as the buffer may be reused
+        if not varlen:
+            buffer[end:offset + segment_size] = ZEROES[:offset + segment_size - end]
+
+    @staticmethod
+    def pack_all_into(segments, offsets, buffer, varlen = False, segment_size = SEGMENT_SIZE):
+        # Pack all segments into `buffer` at the corresponding offsets,
+        # computing all checksums in one batch before filling them in.
+        view = memoryview(buffer)
+        for segment, offset in zip(segments, offsets):
+            segment.pack_into(buffer, offset, varlen=varlen, segment_size=segment_size)
+        slices = [view[offset:offset + segment.size(varlen, segment_size)] for segment, offset in zip(segments, offsets)]
+        for offset, value in zip(offsets, checksum.checksum_batch(slices)):
+            CHECKSUM.pack_into(buffer, offset + CHECKSUM_OFFSET, value)
+
+    @staticmethod
+    def unpack_sack_blocks(body, data_length):
+        # Unpack the (start, end) SACK blocks from the body of a SACK segment
+        return list(SACK_BLOCK.iter_unpack(body[:data_length]))
+
+    @staticmethod
+    def unpack_payload_size(body, data_length):
+        # Unpack the payload size option from the body of a SYN or SYNACK segment.
+        # Peers that do not send the option use the default payload size, and sizes out of range are clamped.
+        if data_length < PAYLOAD_SIZE_OPTION.size:
+            return PAYLOAD_SIZE
+        return min(max(PAYLOAD_SIZE_OPTION.unpack_from(body)[0], MIN_PAYLOAD_SIZE), MAX_PAYLOAD_SIZE)
 
 class SYNSegment(BTCPSegment):
-    def __init__(self, window):
+    __slots__ = ()
+
+    def __init__(self, window, sack = False, varlen = False, payload_size = PAYLOAD_SIZE):
         # For SYN segments, seq_n is random
-        seq_n = random.randrange(0, 65535)
+        seq_n = random.randrange(0, SEQUENCE_SPACE)
         ack_n = 0
-        super().__init__(seq_n, ack_n, window, b"")
-        self.flags["SYN"] = 1
-        self.byte_flags = self.convert_flags_to_int()
+        # The SACK flag on a SYN means that we are able to receive SACK blocks,
+        # and the VARLEN flag means that we are able to receive segments without padding
+        flags = FLAG_SYN | (FLAG_SACK if sack else 0) | (FLAG_VARLEN if varlen else 0)
+        # The body holds the largest payload size we would like to use
+        super().__init__(seq_n, ack_n, window, PAYLOAD_SIZE_OPTION.pack(payload_size), flags)
 
 class ACKSegment(BTCPSegment):
+    __slots__ = ()
+
     def __init__(self, seq_n, ack_n, window):
-        super().__init__(seq_n, ack_n, window, b"")
-        self.flags["ACK"] = 1
-        self.byte_flags = self.convert_flags_to_int()
+        super().__init__(seq_n, ack_n, window, b"", FLAG_ACK)
+
+class SACKSegment(BTCPSegment):
+    __slots__ = ()
+
+    def __init__(self, seq_n, ack_n, window, blocks):
+        # An ACK carrying selective acknowledgements. Every block is a (start, end) pair of
+        # sequence numbers, such that segments start up to but excluding end have been received.
+        data = b"".join(SACK_BLOCK.pack(start, end) for start, end in blocks)
+        super().__init__(seq_n, ack_n, window, data, FLAG_ACK | FLAG_SACK)
 
 class FINSegment(BTCPSegment):
+    __slots__ = ()
+
     def __init__(self, seq_n, window):
         ack_n = 0
-        super().__init__(seq_n, ack_n, window, b"")
-        self.flags["FIN"] = 1
-        self.byte_flags = self.convert_flags_to_int()
+        super().__init__(seq_n, ack_n, window, b"", FLAG_FIN)
 
 class SYNACKSegment(BTCPSegment):
-    def __init__(self, seq_n, ack_n, window):
+    __slots__ = ()
+
+    def __init__(self, seq_n, ack_n, window, sack = False, varlen = False, payload_size = PAYLOAD_SIZE):
         # For SYN segments, seq_n is random
-        super().__init__(seq_n, ack_n, window, b"")
-        self.flags["ACK"] = 1
-        self.flags["SYN"] = 1
-        self.byte_flags = self.convert_flags_to_int()
+        # The SACK and VARLEN flags on a SYNACK mean that these options will be used for this connection,
+        # and the body holds the payload size that will be used
+        flags = FLAG_ACK | FLAG_SYN | (FLAG_SACK if sack else 0) | (FLAG_VARLEN if varlen else 0)
+        super().__init__(seq_n, ack_n, window, PAYLOAD_SIZE_OPTION.pack(payload_size), flags)
 
 class FINACKSegment(BTCPSegment):
+    __slots__ = ()
+
     def __init__(self, window):
         # For FINACK segments, seq_n and ack_n are both unused, and are hence set to 0
         seq_n = 0
         ack_n = 0
-        super().__init__(seq_n, ack_n, window, b"")
-        self.flags["ACK"] = 1
-        self.flags["FIN"] = 1
-        self.byte_flags = self.convert_flags_to_int()
-
+        super().__init__(seq_n, ack_n, window, b"", FLAG_ACK | FLAG_FIN)
@@ -4,6 +4,9 @@
 # ------------------------
 
 from threading import Lock
+from btcp import checksum, trace
+from btcp.constants import HEADER_SIZE
+from btcp.stats import Statistics, StatsExporter
 
 class BTCPSocket:
     # Base class of BTCPClientSocket and BTCPServerSocket
@@ -18,7 +21,67 @@ class BTCPSocket:
         self._state = 0
 
         self.s_mutex = Lock()
+        # Counters of this socket, see btcp/stats.py
+        self.counters = Statistics()
+        self._exporters = []
+        # Tracer recording the events of this socket, see btcp/trace.py. None if tracing is disabled,
+        # such that the hot paths only pay for a single check.
+        self.tracer = None
     
+    # Called by the lossy layer with a batch of segments that arrived together.
+    # The checksums of the whole batch are verified at once, after which each valid segment is handled.
+    def lossy_layer_input_batch(self, segments):
+        checksums = checksum.checksum_batch([segment_data for segment_data, address in segments])
+        self.counters.segments_received += len(segments)
+        self.counters.bytes_received += sum(len(segment_data) for segment_data, address in segments)
+        for segment, out in zip(segments, checksums):
+            if out != 0:
+                self.print("Corrupted Segment received. Discarding...")
+                self.counters.corrupted += 1
+                if self.tracer is not None:
+                    self.trace_corrupted(segment[0], segment[1][1])
+                continue
+            self.lossy_layer_input(segment, verified=True)
+
+    # Count a segment that was received outside of a batch, and return whether its checksum is valid
+    def verify(self, segment_data):
+        self.counters.segments_received += 1
+        self.counters.bytes_received += len(segment_data)
+        if checksum.get_checksum(segment_data) != 0:
+            self.print("Corrupted Segment received. Discarding...")
+            self.counters.corrupted += 1
+            if self.tracer is not None:
+                self.trace_corrupted(segment_data)
+            return False
+        return True
+
+    # Record a corrupted segment, with its header as received
+    def trace_corrupted(self, segment_data, port = 0):
+        if len(segment_data) >= HEADER_SIZE:
+            self.tracer.segment(trace.CORRUPT, segment_data, port)
+        else:
+            self.tracer.record(trace.CORRUPT, length=len(segment_data), port=port)
+
+    # A snapshot of the counters of this socket, as a dict
+    def stats(self):
+        return self.counters.snapshot()
+
+    # Call `callback` with a snapshot of the counters every `interval` seconds, until the socket is closed
+    def export_stats(self, callback, interval = 1.0):
+        exporter = StatsExporter(self, callback, interval)
+        self._exporters.append(exporter)
+        return exporter
+
+    def stop_exporting(self):
+        for exporter in self._exporters:
+            exporter.stop()
+        self._exporters = []
+
+    # Record the events of this socket into a ring buffer of `capacity` events, and return the Tracer
+    def enable_tracing(self, capacity = 1 << 16):
+        self.tracer = trace.Tracer(capacity)
+        return self.tracer
+
     def print(self, string: str):
         if self._debug:
             print(string)
@@ -32,6 +95,10 @@ class BTCPSocket:
     def state(self, value):
         with self.s_mutex:
             if value != self._state:
-                self.print(f"Setting {self._type} state to {value}.")
+                # Only format the message if it is printed
+                if self._debug:
+                    self.print(f"Setting {self._type} state to {value}.")
+                if self.tracer is not None:
+                    self.tracer.record(trace.STATE, length=value)
                 self._state = value
 
@@ -0,0 +1,91 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import numpy as np
+
+# Internet-style one's complement checksum over a segment.
+# The segment is interpreted as a sequence of little-endian 16 bit words,
+# an odd trailing byte is treated as a word with a zero high byte.
+# The result is byte-swapped, such that a segment with a correct checksum
+# filled in results in a checksum of 0.
+
+def _fold(checksum):
+    # Remove overflow
+    checksum = (checksum >> 16) + (checksum & 0xffff)
+    checksum += (checksum >> 16)
+    # Flip and remove overflow
+    out = ~checksum
+    out &= 0xffff
+    return out >> 8 | (out << 8 & 0xff00)
+
+def checksum_python(packet):
+    # Round down to nearest multiple of 2
+    n = (len(packet) // 2) * 2
+    checksum = 0
+
+    # Range from 0 to count with steps of 2
+    for i in range(0, n, 2):
+        checksum += packet[i + 1] * 256 + packet[i]
+        checksum &= 0xffffffff
+
+    # If len(packet) is not a multiple of two, add the final packet
+    if n < len(packet):
+        checksum += packet[-1]
+        checksum &= 0xffffffff
+
+    return _fold(checksum)
+
+def checksum_numpy(packet):
+    # View the even part of the packet as little-endian uint16 words, without copying,
+    # and sum them in one go. A uint64 accumulator can't overflow for any UDP datagram.
+    n = len(packet) // 2
+    checksum = int(np.frombuffer(packet, dtype="<u2", count=n).sum(dtype=np.uint64))
+
+    # If len(packet) is not a multiple of two, add the final packet
+    if n * 2 < len(packet):
+        checksum += packet[-1]
+
+    return _fold(checksum & 0xffffffff)
+
+def checksum_batch(packets):
+    # Compute the checksums of many packets at once, returned as a list of ints.
+    # Packets are zero padded to the same even length, which does not affect the sum,
+    # after which all rows are summed in a single call.
+    if not packets:
+        return []
+    lengths = {len(packet) for packet in packets}
+    width = max(lengths)
+    if len(lengths) == 1 and width % 2 == 0:
+        # Common case: equally sized packets can simply be concatenated
+        matrix = np.frombuffer(b"".join(packets), dtype=np.uint8).reshape(len(packets), width)
+    else:
+        width += width % 2
+        matrix = np.zeros((len(packets), width), dtype=np.uint8)
+        for row, packet in zip(matrix, packets):
+            row[:len(packet)] = np.frombuffer(packet, dtype=np.uint8)
+    checksums = matrix.view("<u2").sum(axis=1, dtype=np.uint64) & 0xffffffff
+
+    # Vectorised equivalent of _fold
+    checksums = (checksums >> 16) + (checksums & 0xffff)
+    checksums += (checksums >> 16)
+    checksums = ~checksums & 0xffff
+    checksums = checksums >> 8 | (checksums << 8 & 0xff00)
+    return checksums.tolist()
+
+# Available checksum backends, which can be selected using set_backend
+BACKENDS = {
+    "python": checksum_python,
+    "numpy": checksum_numpy,
+}
+_backend = checksum_numpy
+
+def set_backend(name: str):
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown checksum backend {name!r}, expected one of {sorted(BACKENDS)}")
+    _backend = BACKENDS[name]
+
+def get_checksum(packet):
+    return _backend(packet)
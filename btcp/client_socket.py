@@ -6,8 +6,47 @@
 import time, threading
 from btcp.btcp_socket import BTCPSocket
 from btcp.lossy_layer import LossyLayer
+from btcp.rtt import RTTEstimator
+from btcp.timer import TimerQueue
+from btcp.file_io import mapped_file
+from btcp import congestion, trace
 from btcp.constants import *
 from btcp.btcp_segment import BTCPSegment, ACKSegment, SYNSegment, SYNACKSegment, FINSegment
+from btcp.sequence import seq_add, seq_distance, seq_diff
+
+# Split `source` into payloads of at most `size` bytes.
+# Both binary and text file objects are supported, as well as bytes-like objects
+# and any other iterable of bytes. Only a single payload is read ahead.
+def iter_payloads(source, size = PAYLOAD_SIZE):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for i in range(0, len(view), size):
+            yield view[i:i + size]
+        return
+
+    if hasattr(source, "read"):
+        chunks = iter(lambda: source.read(size), source.read(0))
+    else:
+        chunks = iter(source)
+
+    pending = bytearray()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        # Fast path, e.g. for binary files: the chunk is exactly one payload
+        if not pending and len(chunk) == size:
+            yield chunk
+            continue
+        pending += chunk
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+    if pending:
+        yield bytes(pending)
+
+# Keys of the retransmission timers of the SYN and FIN, next to the indices of the data segments
+SYN_TIMER = "SYN"
+FIN_TIMER = "FIN"
 
 # bTCP client socket
 # A client application makes use of the services provided by bTCP by calling connect, send, disconnect, and close
@@ -20,10 +59,27 @@ from btcp.btcp_segment import BTCPSegment, ACKSegment, SYNSegment, SYNACKSegment
 # 4: Sending data
 
 class BTCPClientSocket(BTCPSocket):
-    def __init__(self, window, timeout, debug, retries):
+    def __init__(self, window, timeout, debug, retries, sack = True, congestion_control = "cubic", lossy_layer = LossyLayer, varlen = True,
+                 payload_size = PAYLOAD_SIZE):
         super().__init__(window, timeout, debug, "Client")
         self.retries = retries
-        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+        # Whether we are able to receive SACK blocks, and whether the server agreed to send them
+        self.sack = sack
+        self.sack_enabled = False
+        # Whether we are able to receive segments without padding, and whether the server agreed to send them
+        self.varlen = varlen
+        self.varlen_enabled = False
+        # The largest payload size we would like to use, and the payload size agreed on with the server
+        if not MIN_PAYLOAD_SIZE <= payload_size <= MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Payload size {payload_size} is not between {MIN_PAYLOAD_SIZE} and {MAX_PAYLOAD_SIZE}")
+        self.max_payload_size = payload_size
+        self.payload_size = PAYLOAD_SIZE
+        # The congestion window limits the number of segments in flight alongside the advertised window
+        self.congestion_control = congestion_control
+        self.congestion = congestion.create(congestion_control, window)
+        self.congestion_history = False
+        # The lossy layer is created through a factory with the signature of LossyLayer, so it can be replaced
+        self._lossy_layer = lossy_layer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
         # Threading event for connections
         self._connection_event = threading.Event()
         # Set default values
@@ -31,179 +87,442 @@ class BTCPClientSocket(BTCPSocket):
         self.last_acked = 0
         self.last_sent = 0
         self.x = []
+        # Sequence number of the first data segment, which follows the sequence number of our SYN
+        self.isn = 0
+        # Number of duplicate ACKs for the first unacknowledged segment
         self.duplicate = 0
-        self.last_duplicate_ack = -1
-        self.mutex = threading.Lock()
+        self.n_segments = None
+        self.retransmit = False
+        self.recover = -1
+        self.lost = -1
+        self.retransmitted = set()
+        self.sacked = set()
+        self.highest_sacked = -1
+        # The retransmission timeout adapts to the measured round trip time, starting from `timeout`
+        self.rtt = RTTEstimator(timeout / 1000)
+        # Retransmission timers of the segments in flight by index, and of the SYN and FIN by SYN_TIMER and FIN_TIMER
+        self.timers = TimerQueue()
+        # Time at which the retransmission timer was last restarted due to a retransmission
+        self.timer_start = 0
+        # Guards the sending state. The send loop waits on it until it is notified of an incoming ACK.
+        self.mutex = threading.Condition()
 
     # Called by the lossy layer from another thread whenever a segment arrives. 
-    def lossy_layer_input(self, segment):
+    def lossy_layer_input(self, segment, verified = False):
         # Split segment into values
         segment_data, (c_ip, c_port) = segment
         # Unpack the segment into the corresponding values
-        seq_n, ack_n, flags_int, window, data_length, checksum, body = BTCPSegment.unpack(segment_data)
-        flags = BTCPSegment.convert_int_to_flags(flags_int)
-        # Check whether this segment should be discarded
-        out = BTCPSegment.get_checksum(segment_data)
-        if out != 0:
-            self.print("Corrupted Segment received. Discarding...")
+        # Discard datagrams that are too short to hold a header
+        if len(segment_data) < HEADER_SIZE:
+            return
+        # Check whether this segment should be discarded, unless that was already done for its batch
+        if not verified and not self.verify(segment_data):
             return
+        seq_n, ack_n, flags, window, data_length, checksum, body = BTCPSegment.unpack(segment_data)
+        if self.tracer is not None:
+            self.tracer.record(trace.RX, flags, seq_n, ack_n, window, data_length, c_port)
+        sack = bool(flags & FLAG_SACK)
+        varlen = bool(flags & FLAG_VARLEN)
+        flags &= ~OPTION_FLAGS
         
         # Update the receive window to the advertised window by the server
         self.receive_window = window
 
         # If in state "SYN sent, waiting on SYNACK" and flag is SYNACK
-        if self.state == 1 and flags == {"SYN", "ACK"} and ack_n in self.x:
+        if self.state == 1 and flags == FLAG_SYN | FLAG_ACK and ack_n in self.x:
             new_seq_n = ack_n
-            new_ack_n = seq_n + 1
-            self._lossy_layer.send_segment(ACKSegment(new_seq_n, new_ack_n, self._window).pack())
+            new_ack_n = seq_add(seq_n, 1)
+            # Data segments are numbered starting from the sequence number after our SYN
+            self.isn = ack_n
+            # The server will send SACK blocks if it set the SACK flag
+            self.sack_enabled = self.sack and sack
+            # From here on, segments are not padded if the server agreed
+            self.varlen_enabled = self.varlen and varlen
+            self.payload_size = min(BTCPSegment.unpack_payload_size(body, data_length), self.max_payload_size)
+            self.send_segment(self.pack(ACKSegment(new_seq_n, new_ack_n, self._window)))
             # Set state to connected
             self.state = 2
             self._connection_event.set()
             self.print("-= Connection Established =-")
+            # Wake up connect
+            with self.mutex:
+                self.mutex.notify_all()
 
         # Receive FINACK from Server after attempting to disconnect
-        elif self.state == 3 and flags == {"FIN", "ACK"}:
+        elif self.state == 3 and flags == FLAG_FIN | FLAG_ACK:
             # Disconnect, state will already be set to 0 in disconnect()
             self.print("-= Connection Terminated =-")
             self._connection_event.clear()
+            # Wake up disconnect
+            with self.mutex:
+                self.mutex.notify_all()
 
         # If there is an ACK from the Server in response to our sending
-        elif flags == {"ACK"} and self.state == 4:
-            # Translate the ack_n (ranging from 0..65535), to a value from 0..n_segments - 1.
-            # Do this using the list of sequence numbers. If the ack_n is not in the list, 
-            # then it is the ACK for the final segment, and we are done sending.
-            try:
-                new_ack = self.seq_ns.index(ack_n)
-                # Check for a duplicate ack. 
-                # Note that we only allow duplicate ACKs once per sequence number.
-                if self.last_acked == new_ack and self.last_duplicate_ack < new_ack:
-                    self.duplicate += 1
-                else:
-                    self.last_acked = max(new_ack, self.last_acked)
-                    self.duplicate = 0
-            except ValueError:
-                self.last_acked = -1
-                self.duplicate = 0
-            
-            # If there is a triple duplicate ACK, get a hold of the mutex for send_times, 
-            # last_sent and last_acked, and hit the timeout.
-            if self.duplicate >= 3:
-                self.print(f"Triple Duplicate ACK received. Resetting last_sent from {self.last_sent} to {self.last_acked}")
-                self.duplicate = 0
-                self.last_duplicate_ack = new_ack
-                with self.mutex:
-                    # Reset time dictionary
-                    self.send_times = {}
-                    # Reset last sent to last acked to resend segments
-                    self.last_sent = self.last_acked
+        elif flags == FLAG_ACK and self.state == 4:
+            with self.mutex:
+                self.handle_ack(ack_n, sack, body, data_length)
+                # Wake up the send loop, which may now send new segments or retransmit lost ones
+                self.mutex.notify()
+
+    # Handle a batch of segments while holding the mutex, such that the send loop is woken up only once
+    def lossy_layer_input_batch(self, segments):
+        with self.mutex:
+            super().lossy_layer_input_batch(segments)
+
+    # Process an ACK received while sending. Must be called while holding self.mutex.
+    def handle_ack(self, ack_n, sack, body, data_length):
+        # Translate the 16 bit ack_n to the index of the next segment the server expects, relative to
+        # the first unacknowledged segment. If that is not a segment in flight, then it is an old ACK.
+        if self.last_acked == -1:
+            return
+        new_ack = self.last_acked + seq_diff(seq_add(self.isn, self.last_acked), ack_n)
+        if not self.last_acked <= new_ack <= self.last_sent:
+            return
+        # If the final segment is ACKed, we are done sending.
+        if new_ack == self.n_segments:
+            self.last_acked = -1
+            self.duplicate = 0
+            self.timers.clear()
+        # Check for a duplicate ACK. Every duplicate ACK means that a segment after the
+        # first unacknowledged one has left the network.
+        elif self.last_acked == new_ack:
+            self.counters.duplicate_acks += 1
+            self.duplicate += 1
+        else:
+            # Measure the round trip time of the most recently acknowledged segment. Following Karn's rule,
+            # no samples are taken during a recovery episode, as the segment may have been retransmitted,
+            # or its ACK may have been held back by an earlier lost segment.
+            if new_ack > self.last_acked >= self.recover:
+                send_time = self.timers.armed_at(new_ack - 1)
+                if send_time is not None:
+                    rtt = time.time() - send_time
+                    self.rtt.sample(rtt)
+                    self.counters.add_rtt(rtt)
+            # A partial ACK, which advances last_acked but does not cover everything that was in flight
+            # when we last retransmitted, means that the next segment was lost as well.
+            if self.last_acked < new_ack < self.recover:
+                self.lost = new_ack
+                self.retransmit = True
+            if new_ack > self.last_acked:
+                self.sacked = {index for index in self.sacked if index >= new_ack}
+                # Stop the timers of the acknowledged segments
+                for index in range(self.last_acked, new_ack):
+                    self.timers.cancel(index)
+            self.last_acked = max(new_ack, self.last_acked)
+            self.duplicate = 0
+
+        # Mark the segments in the SACK blocks as received, so they are skipped when retransmitting.
+        # Once three segments after the first unacknowledged one have been received, the segments
+        # in between are considered lost, similar to a triple duplicate ACK.
+        if sack and self.sack_enabled:
+            first_unacked = seq_add(self.isn, self.last_acked)
+            for start, end in BTCPSegment.unpack_sack_blocks(body, data_length):
+                first = self.last_acked + seq_diff(first_unacked, start)
+                last = min(first + seq_distance(start, end), self.last_sent)
+                self.sacked.update(range(max(first, self.last_acked + 1), last))
+                self.highest_sacked = max(self.highest_sacked, last - 1)
+            if len(self.sacked) >= 3:
+                self.retransmit = True
+
+        # If there is a triple duplicate ACK, the segment the server expects is most likely lost.
+        # Let the send loop retransmit only that segment. Further duplicate ACKs only inflate the window.
+        if self.duplicate == 3:
+            if self._debug:
+                self.print(f"Triple Duplicate ACK received. Retransmitting segment {self.last_acked}")
+            self.lost = new_ack
+            self.retransmit = True
+
+    # Get the indices of the segments that are considered lost, in order. After a timeout, all segments
+    # in flight that have not been SACKed are considered lost. Otherwise, the first unacknowledged
+    # segment is lost after a triple duplicate ACK or partial ACK, and with SACK, any segment is
+    # lost once at least three segments after it have been SACKed.
+    def get_lost_segments(self, first, timed_out):
+        if timed_out:
+            return [index for index in range(first, self.last_sent) if index not in self.sacked]
+        lost = []
+        sacked_after = 0
+        if self.sack_enabled:
+            for index in range(self.highest_sacked, first, -1):
+                if index in self.sacked:
+                    sacked_after += 1
+                elif sacked_after >= 3:
+                    lost.append(index)
+        if first == self.lost or sacked_after >= 3:
+            lost.append(first)
+        return lost[::-1]
 
     # Perform a three-way handshake to establish a connection
     def connect(self):
         # Set state to "SYN sent, waiting on SYNACK"
         self.state = 1
-        tries = 0
+        # Retransmissions of the SYN use the same random sequence number, so client and server agree on
+        # the sequence number of the first data segment. Note that we store a list of sequence numbers + 1.
+        # If the server has one of these values in the ack_n field of their ACKSYN,
+        # then we proceed with the threeway handshake.
+        segment = SYNSegment(self._window, self.sack, self.varlen, self.max_payload_size)
+        self.x.append(seq_add(segment.seq_n, 1))
         # Send at most self.retries connection attempts until we are connected.
-        while not self._connection_event.is_set() and tries < self.retries:
-            segment = SYNSegment(self._window)
-            # Note that we store a list of sequence numbers + 1.
-            # If the server has one of these values in the ack_n field of their ACKSYN,
-            # then we proceed with the threeway handshake.
-            self.x.append(segment.seq_n + 1)
-            self._lossy_layer.send_segment(segment.pack())
-            tries += 1
-            time.sleep(self._timeout / 1000)
-        # If afterward we still aren't connected, reset 
-        if not self._connection_event.is_set():
+        # The SYN itself is always padded, as we do not know yet whether the server accepts shorter segments.
+        # If afterward we still aren't connected, reset
+        if not self.send_until(SYN_TIMER, segment.pack(), self._connection_event.is_set):
             self.close()
             raise Exception("Could not connect to Server.")
     
-    # Send data originating from the application in a reliable way to the server
-    def send(self, file_obj):
+    # Send data originating from the application in a reliable way to the server.
+    # `source` may be a (binary or text) file object, a bytes-like object or any iterable of bytes.
+    # Segments are produced lazily, so only the unacknowledged window is kept in memory.
+    def send(self, source):
         # If the state is "Connected"
         if self.state == 2:
-            # Set state to "Sending data"
-            self.state = 4
-
-            # Get all data, and split it up into chunks of at most 1008 bytes
-            byte_arr = bytearray(file_obj.read().encode())
-            n = 1008
-
-            # Get a list of BTCPSegments to send with actual data
-            btcp_segments = []
-            for i in range(0, len(byte_arr), n):
-                data_length = len(byte_arr[i:i + n])
-                seq_n = i % 65535
-                ack_n = (seq_n + data_length) % 65535
-                btcp_segments.append(BTCPSegment(seq_n, ack_n, self._window, byte_arr[i:i + n]))
-            
-            # Add one more BTCPSegment, with no data, modified to have a data_length of 65535
-            # This segment acts as a "final" segment.
-            final_seq_n = (i + data_length) % 65535
-            final_ack_n = (final_seq_n + 1008) % 65535
-            btcp_segments.append(BTCPSegment(final_seq_n, final_ack_n, self._window, b""))
-            btcp_segments[-1].data_length = 65534
-
-            # Get list of sequence numbers, number of segments total and a dict to store timeout times
-            self.seq_ns = [segment.seq_n for segment in btcp_segments]
-            self.n_segments = len(self.seq_ns)
-            self.send_times = {}
-            
-            # Loop until self.last_acked is -1, which only occurs when the very last segment is ACKed
-            while self.last_acked != -1:
-                # Ensure mutual exclusion of this portion. The lossy layer thread will rarely attempt to access this lock
-                # That thread only wants this mutex when there is a triple duplicate ACK and wants to reset
-                with self.mutex:
-                    # Get number of segments to send
-                    num_to_send = min(
-                        self.receive_window - (self.last_sent - self.last_acked), 
-                        self.n_segments - self.last_sent
-                    )
-
-                    for n in range(num_to_send):
-                        # Store time sent in dict for this segment
-                        self.send_times[self.last_sent] = time.time()
-                        # Send Segment and increment self.last_sent
-                        self._lossy_layer.send_segment(btcp_segments[self.last_sent].pack())
-                        self.last_sent += 1
-
-                    # Shrink timer dictionary by removing acked segments
-                    self.send_times = {key: self.send_times[key] for key in self.send_times if key > self.last_acked}
-
-                    # If the timer dict is not empty
-                    if self.send_times:
-                        # If any segment is going to be timed out, it will be the first value in the send_times dictionary
-                        # In Python 3.6+, dicts are guaranteed to be ordered.
-                        seq_n, send_time = next(iter(self.send_times.items()))
-                        if time.time() > send_time + (self._timeout / 1000):
-                            self.print(f"Timeout hit. Resetting last_sent from {self.last_sent} to {self.last_acked}")
-                            # Reset dictionary
-                            self.send_times = {}
-                            # Reset last sent to last acked to resend segments
-                            self.last_sent = self.last_acked
+            self.start_sending(source)
+            # Rather than polling, the send loop sleeps until an ACK arrives or the retransmission timer expires
+            with self.mutex:
+                # Loop until self.last_acked is -1, which only occurs when the very last segment is ACKed
+                while self.last_acked != -1:
+                    deadline = self.pump()
+                    if self.last_acked == -1:
+                        break
+                    self.mutex.wait(None if deadline is None else max(deadline - time.time(), 0))
         else:
             self.close()
             raise Exception("Not Connected to Server, cannot send")
 
+    # Send the file at `path` in a reliable way to the server. The file is memory-mapped, such that payloads are
+    # slices of the mapped file, which are copied only once: straight into the send buffer.
+    def send_file(self, path):
+        with mapped_file(path) as source:
+            try:
+                self.send(source)
+            finally:
+                # The map can only be closed once no payload refers to it anymore
+                self.payloads = None
+
+    # Prepare sending the data from `source`, after which the data is sent by repeatedly calling pump
+    def start_sending(self, source):
+        # Set state to "Sending data"
+        self.state = 4
+        self.payloads = iter_payloads(source, self.payload_size)
+        # Send buffer with room for one window of packed segments.
+        # Segment i is stored in slot i % capacity, and (re)transmissions only send
+        # a memoryview slice of this buffer, without any repacking.
+        self.capacity = self._window
+        self.segment_size = HEADER_SIZE + self.payload_size
+        self.packed = memoryview(bytearray(self.capacity * self.segment_size))
+        # The length of the packed segment in every slot, which is shorter than segment_size for
+        # short segments if varlen is enabled
+        self.lengths = [self.segment_size] * self.capacity
+        # Number of segments produced so far. Segment i has sequence number isn + i, modulo 2^16.
+        self.n_produced = 0
+        # The total number of segments, known once the final segment is produced
+        self.n_segments = None
+        self.sacked = set()
+        self.highest_sacked = -1
+        self.timers.clear()
+        self.timer_start = 0
+        # Index of the first unacknowledged segment the last time the congestion window was updated
+        self.cwnd_acked = 0
+        # Whether sending is stopped because the window advertised by the server is full
+        self.stalled = False
+
+    # The packed segment with index `index`, as a slice of the send buffer
+    def packed_segment(self, index):
+        slot = index % self.capacity
+        offset = slot * self.segment_size
+        return self.packed[offset:offset + self.lengths[slot]]
+
+    # Pack a control segment, with the options agreed on with the server
+    def pack(self, segment):
+        return segment.pack(self.varlen_enabled, HEADER_SIZE + self.payload_size)
+
+    # Put a packed segment into the network, counting it
+    def send_segment(self, segment):
+        self.counters.segments_sent += 1
+        self.counters.bytes_sent += len(segment)
+        if self.tracer is not None:
+            self.tracer.segment(trace.TX, segment)
+        self._lossy_layer.send_segment(segment)
+
+    # Put a batch of packed segments into the network, counting them.
+    # `event` is the event under which they are traced, which is trace.RETRANSMIT for retransmissions.
+    def send_segments(self, segments, event = trace.TX):
+        self.counters.segments_sent += len(segments)
+        self.counters.bytes_sent += sum(map(len, segments))
+        if self.tracer is not None:
+            self.tracer.segments(event, segments)
+        self._lossy_layer.send_segments(segments)
+
+    # The counters, together with the current state of the congestion control and RTT estimation
+    def stats(self):
+        stats = super().stats()
+        stats.update(state=self.state, cwnd=self.congestion.cwnd, ssthresh=self.congestion.ssthresh,
+                     srtt=self.rtt.srtt, rto=self.rtt.rto)
+        return stats
+
+    # Record the history of the congestion window in self.congestion.history, also after the socket is closed
+    def enable_congestion_history(self):
+        self.congestion_history = True
+        self.congestion.enable_history()
+
+    # The congestion window, inflated during loss recovery by one segment for every duplicate ACK, as each of them
+    # means that a segment has left the network. This keeps new segments flowing while the lost one is retransmitted.
+    # Once the lost segment is acknowledged, the duplicate ACKs are reset, which deflates the window again.
+    def congestion_window(self):
+        if self.last_acked < self.recover:
+            return self.congestion.window + self.duplicate
+        return self.congestion.window
+
+    # Send new segments and retransmit lost ones, without blocking. Must be called while holding self.mutex.
+    # Returns the time at which the retransmission timer expires, or None if nothing is in flight.
+    def pump(self):
+        last_acked = self.last_acked
+        if last_acked == -1:
+            return None
+        capacity = self.capacity
+
+        # Grow the congestion window for newly acknowledged segments, except during loss recovery
+        if last_acked > self.cwnd_acked:
+            if last_acked >= self.recover:
+                self.congestion.on_ack(last_acked - self.cwnd_acked, time.time(), self.rtt.srtt)
+            self.cwnd_acked = last_acked
+
+        # Produce and pack new segments into the free slots
+        new_segments = []
+        while self.n_produced < last_acked + capacity and self.n_segments is None:
+            # Sequence numbers count segments rather than bytes, such that the server can place
+            # out-of-order segments in its window. The ack_n is the seq_n of the next segment.
+            seq_n = seq_add(self.isn, self.n_produced)
+            ack_n = seq_add(seq_n, 1)
+            payload = next(self.payloads, None)
+            if payload is None:
+                # Add one more BTCPSegment, with no data, modified to have a data_length of 65534
+                # This segment acts as a "final" segment.
+                segment = BTCPSegment(seq_n, ack_n, self._window, b"")
+                segment.data_length = 65534
+                self.n_segments = self.n_produced + 1
+            else:
+                segment = BTCPSegment(seq_n, ack_n, self._window, payload)
+            slot = self.n_produced % capacity
+            self.lengths[slot] = segment.size(self.varlen_enabled, self.segment_size)
+            new_segments.append((segment, slot * self.segment_size))
+            self.n_produced += 1
+        if new_segments:
+            BTCPSegment.pack_all_into(*zip(*new_segments), self.packed, self.varlen_enabled, self.segment_size)
+
+        # Get number of segments to send, limited by both the advertised and the congestion window.
+        # If the server advertises a window of 0 and nothing is in flight, still send a single
+        # segment, as otherwise no new ACK would ever tell us that the window has opened up again.
+        num_to_send = min(
+            min(max(self.receive_window, 1), capacity, self.congestion_window()) - (self.last_sent - last_acked),
+            self.n_produced - self.last_sent
+        )
+
+        batch = []
+        now = time.time()
+        for n in range(num_to_send):
+            # Start the retransmission timer of this segment
+            self.timers.arm(self.last_sent, now)
+            # Queue Segment and increment self.last_sent
+            batch.append(self.packed_segment(self.last_sent))
+            self.last_sent += 1
+        # Send all new segments with as few system calls as possible
+        if batch:
+            self.send_segments(batch)
+
+        # Count the times that sending stops because the window advertised by the server is full
+        stalled = self.n_produced > self.last_sent and self.last_sent - last_acked >= self.receive_window
+        if stalled and not self.stalled:
+            self.counters.window_stalls += 1
+        self.stalled = stalled
+
+        # If no timer is armed, nothing is in flight
+        first = self.timers.first()
+        if first is None:
+            return None
+
+        # If any segment is going to be timed out, it will be the one whose timer was armed first
+        send_time = first[1]
+        now = time.time()
+        timed_out = now >= max(send_time, self.timer_start) + self.rtt.rto
+        # While the server advertises a window of 0, a timeout does not mean that the network is congested, but that
+        # the server has no room yet, or that its window update was lost. Probe the window by resending the first
+        # unacknowledged segment, without backing off or reducing the congestion window.
+        if timed_out and self.receive_window == 0:
+            self.timers.arm(last_acked, now)
+            self.send_segments([self.packed_segment(last_acked)], trace.RETRANSMIT)
+            self.counters.window_probes += 1
+            self.timer_start = now
+            return now + self.rtt.rto
+        if self.retransmit or timed_out:
+            self.retransmit = False
+            lost = self.get_lost_segments(last_acked, timed_out)
+            # Back off exponentially on every timeout, until a new RTT sample is taken
+            if timed_out:
+                if self._debug:
+                    self.print(f"Timeout hit after {self.rtt.rto * 1000:.0f}ms. Retransmitting segment {last_acked}")
+                if self.tracer is not None:
+                    self.tracer.record(trace.TIMEOUT, seq_n=seq_add(self.isn, last_acked), length=round(self.rtt.rto * 1000))
+                self.rtt.backoff()
+                self.congestion.on_timeout(now, self.last_sent - last_acked)
+            # Start a new recovery episode on a timeout, or if the previous one is over.
+            # The congestion window is reduced once per episode.
+            if lost and (timed_out or last_acked >= self.recover):
+                if not timed_out:
+                    self.congestion.on_loss(now, self.last_sent - last_acked)
+                self.retransmitted = set()
+                self.recover = self.last_sent
+            # The server buffers out-of-order segments, so only the lost segments are retransmitted,
+            # each at most once per recovery episode. The others will be acknowledged once the gaps are filled.
+            batch = []
+            for index in lost:
+                if index not in self.retransmitted:
+                    self.retransmitted.add(index)
+                    batch.append(self.packed_segment(index))
+                    self.timers.arm(index, now)
+            if batch:
+                self.send_segments(batch, trace.RETRANSMIT)
+                if timed_out:
+                    self.counters.retransmissions_timeout += len(batch)
+                else:
+                    self.counters.retransmissions_fast += len(batch)
+            # Restart the timer, so the remaining segments get the chance to be acknowledged
+            if lost or timed_out:
+                self.timer_start = now
+        return max(self.timers.first()[1], self.timer_start) + self.rtt.rto
+
+    # Send the packed control segment `segment` until `done()` holds, at most self.retries times. It is retransmitted
+    # whenever its timer `key` expires, and the incoming segment that makes `done()` hold wakes us up.
+    # Returns whether `done()` holds.
+    def send_until(self, key, segment, done):
+        tries = 0
+        with self.mutex:
+            while not done() and tries < self.retries:
+                self.send_segment(segment)
+                tries += 1
+                self.timers.arm(key, time.time())
+                self.mutex.wait_for(done, self.timers.remaining(key, time.time(), self._timeout / 1000))
+            self.timers.cancel(key)
+            return done()
+
     # Perform a handshake to terminate a connection
     def disconnect(self):
         # Only disconnect if not already disconnected
         if self._state != 0:
             self.state = 3
-            tries = 0
             # We use a default sequence number of 0
             seq_n = 0
             segment = FINSegment(seq_n, self._window)
             # Send at most self.retries disconnection attempts until we are disconnected.
-            while self._connection_event.is_set() and tries < self.retries:
-                self._lossy_layer.send_segment(segment.pack())
-                tries += 1
-                time.sleep(self._timeout / 1000)
+            self.send_until(FIN_TIMER, self.pack(segment), lambda: not self._connection_event.is_set())
             # Reset to default state regardless of server response
             self.state = 0
             self._connection_event.clear()
 
     # Clean up any state
     def close(self):
+        # Export a final snapshot of the counters before the state is reset
+        self.stop_exporting()
+        if self.tracer is not None:
+            self.tracer.record(trace.RESET)
         # Reset all variables to defaults
         self._connection_event.clear()
         self.state = 0
@@ -211,7 +530,23 @@ class BTCPClientSocket(BTCPSocket):
         self.last_acked = 0
         self.last_sent = 0
         self.x = []
+        self.isn = 0
         self.duplicate = 0
-        self.last_duplicate_ack = -1
+        self.n_segments = None
+        self.retransmit = False
+        self.recover = -1
+        self.lost = -1
+        self.retransmitted = set()
+        self.sacked = set()
+        self.highest_sacked = -1
+        self.sack_enabled = False
+        self.varlen_enabled = False
+        self.payload_size = PAYLOAD_SIZE
+        self.rtt = RTTEstimator(self._timeout / 1000)
+        self.timers.clear()
+        self.timer_start = 0
+        self.congestion = congestion.create(self.congestion_control, self._window)
+        if self.congestion_history:
+            self.congestion.enable_history()
         # Destroy lossy layer thread
         self._lossy_layer.destroy()
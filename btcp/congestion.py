@@ -0,0 +1,128 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import abc, time
+from btcp.constants import *
+
+# Congestion control for the client send loop. The congestion window (cwnd) is measured
+# in segments, and the client never has more than min(cwnd, advertised window) segments in flight.
+# Once enabled with `enable_history()`, each change of cwnd is recorded in `history` as a (time, cwnd, ssthresh) tuple.
+# It is disabled by default, as it grows with the length of the transfer.
+
+class CongestionControl(abc.ABC):
+    def __init__(self, max_window, initial_window = INITIAL_CWND):
+        self.max_window = max_window
+        self.cwnd = float(min(initial_window, max_window))
+        self.ssthresh = float(max_window)
+        self.history = None
+
+    @property
+    def window(self):
+        return max(int(self.cwnd), 1)
+
+    def enable_history(self, now = None):
+        self.history = []
+        self.record(now)
+
+    def record(self, now = None):
+        if self.history is not None:
+            self.history.append((time.time() if now is None else now, self.cwnd, self.ssthresh))
+
+    # Called when `n_acked` new segments were acknowledged outside of loss recovery
+    def on_ack(self, n_acked, now, srtt):
+        if self.cwnd < self.ssthresh:
+            # Slow start: grow by one segment per acknowledged segment
+            self.cwnd += n_acked
+        else:
+            self.congestion_avoidance(n_acked, now, srtt)
+        self.cwnd = min(self.cwnd, self.max_window)
+        self.record(now)
+
+    # Grow cwnd by `n_acked` acknowledged segments once past slow start
+    @abc.abstractmethod
+    def congestion_avoidance(self, n_acked, now, srtt):
+        pass
+
+    # Called once per recovery episode when loss is detected from (duplicate or selective) ACKs
+    @abc.abstractmethod
+    def on_loss(self, now, in_flight):
+        pass
+
+    # Called on a retransmission timeout: start over from slow start
+    def on_timeout(self, now, in_flight):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = 1.0
+        self.record(now)
+
+# Reno: additive increase of one segment per round trip, multiplicative decrease by half
+class Reno(CongestionControl):
+    def congestion_avoidance(self, n_acked, now, srtt):
+        self.cwnd += n_acked / self.cwnd
+
+    def on_loss(self, now, in_flight):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+        self.record(now)
+
+# CUBIC, following RFC 8312. After a loss, cwnd grows along a cubic function of the time since
+# that loss, which quickly returns to the window at which the loss occurred (w_max) and probes
+# carefully around it. It never grows slower than Reno would.
+class Cubic(CongestionControl):
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, max_window, initial_window = INITIAL_CWND):
+        super().__init__(max_window, initial_window)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.epoch_start = None
+
+    def congestion_avoidance(self, n_acked, now, srtt):
+        if self.epoch_start is None:
+            # First congestion avoidance round after slow start
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                self.w_max = self.cwnd
+                self.k = 0.0
+        t = now - self.epoch_start
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * n_acked
+        else:
+            self.cwnd += 0.01 * n_acked / self.cwnd
+        # Estimate of the window Reno would have reached in the same time
+        if srtt:
+            reno = self.w_max * self.BETA + 3 * (1 - self.BETA) / (1 + self.BETA) * t / srtt
+            self.cwnd = max(self.cwnd, reno)
+
+    def on_loss(self, now, in_flight):
+        # Fast convergence: release bandwidth to new flows if we lost before reaching the previous w_max
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.cwnd = max(self.cwnd * self.BETA, 2)
+        self.ssthresh = self.cwnd
+        self.k = (self.w_max * (1 - self.BETA) / self.C) ** (1 / 3)
+        self.epoch_start = now
+        self.record(now)
+
+    def on_timeout(self, now, in_flight):
+        self.w_max = self.cwnd
+        self.epoch_start = None
+        super().on_timeout(now, in_flight)
+
+# Available congestion control algorithms, which can be selected by name
+ALGORITHMS = {
+    "reno": Reno,
+    "cubic": Cubic,
+}
+
+def create(name, max_window):
+    if name not in ALGORITHMS:
+        raise ValueError(f"Unknown congestion control algorithm {name!r}, expected one of {sorted(ALGORITHMS)}")
+    return ALGORITHMS[name](max_window)
@@ -4,9 +4,46 @@
 # ------------------------
 
 CLIENT_IP = 'localhost'
-CLIENT_PORT = 20000
+# Clients bind to an ephemeral port chosen by the OS, such that many clients can run in parallel
+CLIENT_PORT = 0
 SERVER_IP = 'localhost'
 SERVER_PORT = 30000
 HEADER_SIZE = 10
+# Default payload size, which is used unless a larger one is negotiated in the handshake
 PAYLOAD_SIZE = 1008
-SEGMENT_SIZE = HEADER_SIZE + PAYLOAD_SIZE
\ No newline at end of file
+SEGMENT_SIZE = HEADER_SIZE + PAYLOAD_SIZE
+# Largest payload that fits in a single UDP datagram over IPv4, after the 20 byte IP and 8 byte UDP headers
+MAX_PAYLOAD_SIZE = 65535 - 28 - HEADER_SIZE
+MAX_SEGMENT_SIZE = HEADER_SIZE + MAX_PAYLOAD_SIZE
+# Requested size of the receive buffer of UDP sockets in bytes
+RECEIVE_BUFFER_SIZE = 1 << 22
+# Bits of the flags field of the header
+FLAG_FIN = 1
+FLAG_SYN = 2
+FLAG_ACK = 4
+FLAG_SACK = 8
+# Set on SYN and SYNACK if segments are sent without padding, as long as their header and data
+FLAG_VARLEN = 16
+# Flags that negotiate options during the handshake, rather than determine the type of a segment
+OPTION_FLAGS = FLAG_SACK | FLAG_VARLEN
+# Offset of the checksum field within the header
+CHECKSUM_OFFSET = 8
+# Maximum number of SACK blocks in a single ACK
+MAX_SACK_BLOCKS = 16
+# Smallest payload size that can be negotiated, which holds all 4 byte SACK blocks of an ACK
+MIN_PAYLOAD_SIZE = 4 * MAX_SACK_BLOCKS
+# Bounds on the adaptive retransmission timeout, and the clock granularity, in milliseconds
+MIN_TIMEOUT = 100
+MAX_TIMEOUT = 60000
+CLOCK_GRANULARITY = 1
+# The server acknowledges every DELAYED_ACK_SEGMENTS in-order segments, or DELAYED_ACK_TIMEOUT milliseconds
+# after the first unacknowledged one, whichever comes first. Out-of-order segments are acknowledged immediately.
+DELAYED_ACK_SEGMENTS = 2
+DELAYED_ACK_TIMEOUT = 10
+# The server writes received files through memory maps of this many bytes, which are preallocated one at a time.
+# Must be a multiple of mmap.ALLOCATIONGRANULARITY
+FILE_CHUNK_SIZE = 1 << 26
+# Initial congestion window in segments
+INITIAL_CWND = 10
+# Maximum number of datagrams read from the socket before they are handled as one batch
+MAX_BATCH_SIZE = 256
@@ -0,0 +1,259 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import heapq, random, threading, time
+from btcp.constants import *
+
+# An in-process emulation of a lossy network, as a drop-in replacement for the LossyLayer.
+# Segments are passed between endpoints in memory, after applying the same impairments as netem:
+# (burst) loss, corruption, duplication, reordering, delay with jitter and a bandwidth limit.
+# Every direction between two endpoints draws from its own random generator, seeded from the seed of the
+# network, such that the impairments of a run only depend on the segments that are sent.
+# Neither root privileges nor changes to the network of the host are needed.
+
+# Units of the netem time and rate parameters, in seconds and bits per second
+TIME_UNITS = {"s": 1, "ms": 1e-3, "us": 1e-6}
+RATE_UNITS = {"bit": 1, "kbit": 1e3, "mbit": 1e6, "gbit": 1e9, "bps": 8, "kbps": 8e3, "mbps": 8e6, "gbps": 8e9}
+
+def parse_unit(value, units):
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * units[unit]
+    raise ValueError(f"Expected a value ending in one of {sorted(units)}, got {value!r}")
+
+def parse_percentage(value):
+    return float(value.rstrip("%")) / 100
+
+
+# The impairments of a link, with the same meaning as the netem parameters of the same name.
+# Probabilities and correlations are fractions between 0 and 1, times are in seconds, and the rate in bits per second.
+class NetworkConditions:
+    def __init__(self, loss = 0, loss_correlation = 0, corrupt = 0, duplicate = 0, delay = 0, jitter = 0,
+                 reorder = 0, reorder_correlation = 0, rate = None, limit = 1000):
+        self.loss = loss
+        self.loss_correlation = loss_correlation
+        self.corrupt = corrupt
+        self.duplicate = duplicate
+        self.delay = delay
+        self.jitter = jitter
+        # Like netem, reordering requires a delay: the reordered segments are sent immediately instead
+        self.reorder = reorder
+        self.reorder_correlation = reorder_correlation
+        self.rate = rate
+        # Maximum number of segments queued on a link, after which segments are dropped
+        self.limit = limit
+
+    # Parse a netem rule, such as "loss 10% 25% delay 20ms reorder 25% 50%"
+    @classmethod
+    def parse(cls, rule):
+        conditions = cls()
+        tokens = rule.split()
+        # Consume the optional arguments of a parameter, which are the tokens up to the next keyword
+        def arguments():
+            values = []
+            while tokens and tokens[0] not in KEYWORDS:
+                values.append(tokens.pop(0))
+            return values
+        while tokens:
+            keyword = tokens.pop(0)
+            values = arguments()
+            if keyword == "loss":
+                # "loss random 10%" is the same as "loss 10%"
+                values = [value for value in values if value != "random"]
+                conditions.loss = parse_percentage(values[0])
+                if len(values) > 1:
+                    conditions.loss_correlation = parse_percentage(values[1])
+            elif keyword == "corrupt":
+                conditions.corrupt = parse_percentage(values[0])
+            elif keyword == "duplicate":
+                conditions.duplicate = parse_percentage(values[0])
+            elif keyword == "delay":
+                conditions.delay = parse_unit(values[0], TIME_UNITS)
+                if len(values) > 1:
+                    conditions.jitter = parse_unit(values[1], TIME_UNITS)
+            elif keyword == "reorder":
+                conditions.reorder = parse_percentage(values[0])
+                if len(values) > 1:
+                    conditions.reorder_correlation = parse_percentage(values[1])
+            elif keyword == "rate":
+                conditions.rate = parse_unit(values[0], RATE_UNITS)
+            elif keyword == "limit":
+                conditions.limit = int(values[0])
+            else:
+                raise ValueError(f"Unknown netem parameter {keyword!r}")
+        return conditions
+
+KEYWORDS = {"loss", "corrupt", "duplicate", "delay", "reorder", "rate", "limit"}
+
+
+# Random events where every outcome is correlated with the previous one: with probability `correlation`, the
+# previous outcome is repeated, which makes bursts of e.g. losses more likely as it grows. Unlike the correlation of
+# netem, which averages random values, this keeps the average probability of the event unchanged.
+class CorrelatedEvent:
+    def __init__(self, rng):
+        self.rng = rng
+        self.last = False
+
+    def happens(self, probability, correlation):
+        if self.rng.random() >= correlation:
+            self.last = self.rng.random() < probability
+        return self.last
+
+
+# One direction between two endpoints, which holds the state of its impairments
+class Link:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.loss = CorrelatedEvent(self.rng)
+        self.reorder = CorrelatedEvent(self.rng)
+        # Time at which the last queued segment has been transmitted, for the bandwidth limit
+        self.busy_until = 0
+        # Number of segments that are queued on this link
+        self.queued = 0
+
+    # Return the delays after which copies of `segment` should be delivered, and the (possibly corrupted) segment
+    def transmit(self, segment, conditions, now):
+        if conditions.loss and self.loss.happens(conditions.loss, conditions.loss_correlation):
+            return [], segment
+        if self.queued >= conditions.limit:
+            return [], segment
+        if conditions.corrupt and self.rng.random() < conditions.corrupt:
+            # Flip a single random bit
+            segment = bytearray(segment)
+            bit = self.rng.randrange(len(segment) * 8)
+            segment[bit // 8] ^= 1 << (bit % 8)
+            segment = bytes(segment)
+        copies = 2 if conditions.duplicate and self.rng.random() < conditions.duplicate else 1
+
+        # The segment leaves once all segments before it have been transmitted at the given rate
+        start = max(now, self.busy_until)
+        if conditions.rate:
+            self.busy_until = start + len(segment) * 8 / conditions.rate
+        else:
+            self.busy_until = start
+        departure = self.busy_until - now
+        if conditions.delay and conditions.reorder and self.reorder.happens(conditions.reorder, conditions.reorder_correlation):
+            # Send reordered segments without delay, such that they overtake the delayed ones
+            return [departure] * copies, segment
+        delays = []
+        for _ in range(copies):
+            delay = conditions.delay
+            if conditions.jitter:
+                delay += self.rng.uniform(-conditions.jitter, conditions.jitter)
+            delays.append(departure + max(delay, 0))
+        return delays, segment
+
+
+# A network of emulated endpoints. A single thread delivers the segments when their delay has passed.
+# Pass `network.layer` as the `lossy_layer` argument of a socket to connect it to this network.
+class EmulatedNetwork:
+    def __init__(self, conditions = None, seed = 0):
+        if isinstance(conditions, str):
+            conditions = NetworkConditions.parse(conditions)
+        self.conditions = conditions or NetworkConditions()
+        self.seed = seed
+        # Map from address to the socket listening on it
+        self.endpoints = {}
+        self.links = {}
+        # Heap of (delivery time, counter, source address, destination address, segment) tuples
+        self.queue = []
+        self.counter = 0
+        self.next_port = 49152
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.deliver_segments, daemon=True)
+        self.thread.start()
+
+    # Replace the impairments of all links, like `tc qdisc change`. `conditions` may also be a netem rule.
+    def change(self, conditions):
+        if isinstance(conditions, str):
+            conditions = NetworkConditions.parse(conditions)
+        with self.condition:
+            self.conditions = conditions
+
+    # Factory with the signature of LossyLayer
+    def layer(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
+        return EmulatedLayer(self, bTCP_sock, a_ip, a_port, b_ip, b_port)
+
+    def bind(self, bTCP_sock, address):
+        with self.condition:
+            ip, port = address
+            # Like the OS, hand out an ephemeral port for port 0
+            if port == 0:
+                while (ip, self.next_port) in self.endpoints:
+                    self.next_port += 1
+                port = self.next_port
+                self.next_port += 1
+            if (ip, port) in self.endpoints:
+                raise OSError(f"Address {(ip, port)} is already in use")
+            self.endpoints[(ip, port)] = bTCP_sock
+            return (ip, port)
+
+    def unbind(self, address):
+        with self.condition:
+            self.endpoints.pop(address, None)
+
+    # Queue segments from `source` to `destination`, after applying the impairments
+    def send(self, segments, source, destination):
+        with self.condition:
+            link = self.links.get((source, destination))
+            if link is None:
+                link = self.links[(source, destination)] = Link(f"{self.seed}:{source}:{destination}")
+            now = time.monotonic()
+            for segment in segments:
+                # The sender may reuse its buffer, so take a copy
+                delays, segment = link.transmit(bytes(segment), self.conditions, now)
+                for delay in delays:
+                    heapq.heappush(self.queue, (now + delay, self.counter, source, destination, segment))
+                    self.counter += 1
+                    link.queued += 1
+            self.condition.notify()
+
+    # Deliver segments once they are due, batched per destination like the LossyLayer
+    def deliver_segments(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    self.condition.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                if self.closed:
+                    return
+                now = time.monotonic()
+                batches = {}
+                n = 0
+                while self.queue and self.queue[0][0] <= now and n < MAX_BATCH_SIZE:
+                    _, _, source, destination, segment = heapq.heappop(self.queue)
+                    n += 1
+                    self.links[(source, destination)].queued -= 1
+                    batches.setdefault(destination, []).append((segment, source))
+                endpoints = [(self.endpoints.get(destination), batch) for destination, batch in batches.items()]
+            # Segments to an address nobody listens on are dropped
+            for bTCP_sock, batch in endpoints:
+                if bTCP_sock is not None:
+                    bTCP_sock.lossy_layer_input_batch(batch)
+
+    # Stop delivering segments
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+# The endpoint of a socket in an EmulatedNetwork, with the interface of the LossyLayer
+class EmulatedLayer:
+    def __init__(self, network, bTCP_sock, a_ip, a_port, b_ip, b_port):
+        self._network = network
+        self._address = network.bind(bTCP_sock, (a_ip, a_port))
+        self._b_addr = (b_ip, b_port)
+
+    def destroy(self):
+        self._network.unbind(self._address)
+
+    # Put the segment into the network, addressed to b unless another address is given
+    def send_segment(self, segment, address = None):
+        self._network.send([segment], self._address, address or self._b_addr)
+
+    def send_segments(self, segments, address = None):
+        self._network.send(segments, self._address, address or self._b_addr)
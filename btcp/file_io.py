@@ -0,0 +1,62 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import contextlib, mmap, os
+from btcp.constants import FILE_CHUNK_SIZE
+
+# Memory-mapped access to the files that the client sends and the server receives, such that their data is only
+# copied between the mapped file and the send or receive buffer. Writing the pages back to disk is left to the kernel.
+# When an exception is raised, its traceback may still refer to slices of a mapped view, which keep the map from
+# being closed. In that case, the map is closed once it is garbage collected, rather than hiding the exception.
+
+# Map the file at `path` for reading, and yield a memoryview of its contents. Empty files cannot be mapped,
+# so for those, empty bytes are yielded. Slices of the view must not be kept after the block.
+@contextlib.contextmanager
+def mapped_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            yield view
+        mm.close()
+
+# A file at `path` that is written through memory maps of `chunk_size` bytes, which must be a multiple of
+# mmap.ALLOCATIONGRANULARITY. Every chunk is preallocated before it is mapped. When the file is closed,
+# also after an exception, it is truncated to the `size` bytes written, which the writer keeps up to date.
+class PreallocatedFile:
+    def __init__(self, path, chunk_size = FILE_CHUNK_SIZE):
+        self.file = open(path, "w+b")
+        self.chunk_size = chunk_size
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.truncate(self.size)
+        self.file.close()
+
+    # Preallocate and map the chunk that holds the first unwritten byte, and yield a writable memoryview
+    # from that byte to the end of the chunk
+    @contextlib.contextmanager
+    def next_chunk(self):
+        fd = self.file.fileno()
+        offset = self.size - self.size % self.chunk_size
+        try:
+            os.posix_fallocate(fd, offset, self.chunk_size)
+        except (AttributeError, OSError):
+            # Not every platform and file system supports preallocation
+            os.ftruncate(fd, offset + self.chunk_size)
+        mm = mmap.mmap(fd, self.chunk_size, offset=offset)
+        with memoryview(mm) as view, view[self.size - offset:] as unwritten:
+            yield unwritten
+        mm.close()
@@ -3,25 +3,67 @@
 # Bart Janssen - s4630270
 # ------------------------
 
-import socket, select, threading, time
+import socket, select, threading, time, struct
 from btcp.constants import *
 from btcp.btcp_segment import BTCPSegment
 
-# Continuously read from the socket and whenever a segment arrives, 
-# call the lossy_layer_input method of the associated socket. 
+# Linux UDP generic segmentation and receive offload socket options. With UDP_SEGMENT, a single sendmsg
+# call sends a batch of equally sized datagrams, and with UDP_GRO, a single recvmsg call may return a batch.
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+# The kernel accepts at most 64 segments in one UDP_SEGMENT call, which together must fit in a single UDP datagram
+MAX_GSO_SEGMENTS = 64
+GRO_BUFFER_SIZE = 65535
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+# Socket options to set the don't fragment bit on outgoing datagrams, and to read the path MTU
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_MTU = getattr(socket, "IP_MTU", 14)
+# Size of the IPv4 and UDP headers
+UDP_OVERHEAD = 28
+
+# Read all datagrams that are ready on the socket, at most MAX_BATCH_SIZE, without blocking after the first.
+# With GRO, a single read may hold several segments, which are split without copying on the segment size the kernel reports.
+def receive_batch(udp_sock, gro):
+    segments = []
+    flags = 0
+    while len(segments) < MAX_BATCH_SIZE:
+        try:
+            if gro:
+                data, ancdata, _, address = udp_sock.recvmsg(GRO_BUFFER_SIZE, socket.CMSG_SPACE(4), flags)
+                size = next((struct.unpack("=i", cmsg_data[:4])[0] for level, cmsg_type, cmsg_data in ancdata
+                             if level == SOL_UDP and cmsg_type == UDP_GRO), len(data))
+                view = memoryview(data)
+                segments.extend((view[i:i + size], address) for i in range(0, len(data), size))
+            else:
+                # Segments may be as large as the payload size negotiated in any handshake
+                segments.append(udp_sock.recvfrom(MAX_SEGMENT_SIZE, flags))
+        except (BlockingIOError, InterruptedError):
+            break
+        if MSG_DONTWAIT:
+            flags = MSG_DONTWAIT
+        # Without MSG_DONTWAIT, check whether another datagram is ready before reading it
+        elif not select.select([udp_sock], [], [], 0)[0]:
+            break
+    return segments
+
+# Continuously read from the socket and whenever segments arrive,
+# pass them in a batch to the lossy_layer_input_batch method of the associated socket.
 # When flagged, return from the function.
-def handle_incoming_segments(bTCP_sock, event, udp_sock):
+def handle_incoming_segments(bTCP_sock, event, udp_sock, gro):
     while not event.is_set():
         # We do not block here, because we might never check the loop condition in that case
         rlist, wlist, elist = select.select([udp_sock], [], [], 1)
         if rlist:
-            segment = udp_sock.recvfrom(SEGMENT_SIZE)
-            bTCP_sock.lossy_layer_input(segment)
+            segments = receive_batch(udp_sock, gro)
+            if segments:
+                bTCP_sock.lossy_layer_input_batch(segments)
 
 
-# The lossy layer emulates the network layer in that it provides bTCP with 
-# an unreliable segment delivery service between a and b. When the lossy layer is created, 
-# a thread is started that calls handle_incoming_segments. 
+# The lossy layer emulates the network layer in that it provides bTCP with
+# an unreliable segment delivery service between a and b. When the lossy layer is created,
+# a thread is started that calls handle_incoming_segments.
 class LossyLayer:
     def __init__(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
         self._bTCP_sock = bTCP_sock
@@ -30,8 +72,25 @@ class LossyLayer:
         self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._udp_sock.bind((a_ip, a_port))
+        # Large segments fill the default receive buffer after only a few segments, so ask for a larger one.
+        # The kernel limits this to net.core.rmem_max.
+        self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        # Use segmentation offload where the platform supports it, and fall back to a datagram per call otherwise.
+        # Platforms without it may silently ignore the UDP_SEGMENT control message of sendmsg, and send a whole batch
+        # as one datagram, so probe for it with the socket option instead. A segment size of 0 leaves it disabled
+        # for plain sends.
+        try:
+            self._udp_sock.setsockopt(SOL_UDP, UDP_SEGMENT, 0)
+            self._gso = hasattr(socket.socket, "sendmsg")
+        except OSError:
+            self._gso = False
+        try:
+            self._udp_sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+            self._gro = True
+        except OSError:
+            self._gro = False
         self._event = threading.Event()
-        self._thread = threading.Thread(target=handle_incoming_segments, args=(self._bTCP_sock, self._event, self._udp_sock))
+        self._thread = threading.Thread(target=handle_incoming_segments, args=(self._bTCP_sock, self._event, self._udp_sock, self._gro))
         self._thread.start()
 
     # Flag the thread that it can stop and close the socket.
@@ -40,6 +99,74 @@ class LossyLayer:
         self._thread.join()
         self._udp_sock.close()
 
-    # Put the segment into the network
-    def send_segment(self, segment):
-        self._udp_sock.sendto(segment, (self._b_ip, self._b_port))
\ No newline at end of file
+    # Put the segment into the network, addressed to b unless another address is given
+    def send_segment(self, segment, address = None):
+        self._udp_sock.sendto(segment, address or (self._b_ip, self._b_port))
+
+    # Put a batch of segments into the network, using as few system calls as possible.
+    # Runs of equally sized segments are sent with a single UDP_SEGMENT sendmsg call, without joining them.
+    def send_segments(self, segments, address = None):
+        address = address or (self._b_ip, self._b_port)
+        i = 0
+        while i < len(segments):
+            size = len(segments[i])
+            limit = min(MAX_GSO_SEGMENTS, MAX_SEGMENT_SIZE // max(size, 1))
+            j = i + 1
+            while j < len(segments) and j - i < limit and len(segments[j]) == size:
+                j += 1
+            if j - i > 1 and self._gso:
+                try:
+                    self._udp_sock.sendmsg(segments[i:j], [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))], 0, address)
+                    i = j
+                    continue
+                except OSError:
+                    # Segmentation offload is not supported here, so stop trying
+                    self._gso = False
+            for segment in segments[i:j]:
+                self._udp_sock.sendto(segment, address)
+            i = j
+
+
+# Find the largest payload size for which segments reach `ip` without being fragmented. `ip` must be a local address:
+# probes are sent with the don't fragment bit set to a socket bound to it, and a size is too large if the kernel
+# rejects the datagram, or if it does not arrive within `timeout` seconds.
+# Falls back to PAYLOAD_SIZE if the platform does not support probing.
+def probe_payload_size(ip, timeout = 0.1):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        receiver.bind((ip, 0))
+        receiver.settimeout(timeout)
+        sender.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        sender.connect(receiver.getsockname())
+        # The MTU the kernel knows for this path is an upper bound, which is usually right
+        high = min(sender.getsockopt(socket.IPPROTO_IP, IP_MTU) - UDP_OVERHEAD - HEADER_SIZE, MAX_PAYLOAD_SIZE)
+    except OSError:
+        receiver.close()
+        sender.close()
+        return PAYLOAD_SIZE
+    with receiver, sender:
+        if probe(sender, receiver, high):
+            return high
+        # Otherwise, binary search for the largest size between the default and the bound that gets through
+        low = PAYLOAD_SIZE
+        while low < high:
+            size = (low + high + 1) // 2
+            if probe(sender, receiver, size):
+                low = size
+            else:
+                high = size - 1
+        return low
+
+# Send a single probe with a payload of `size` bytes, and return whether it arrived
+def probe(sender, receiver, size):
+    datagram = bytes(HEADER_SIZE + size)
+    try:
+        sender.send(datagram)
+        while True:
+            # Skip any late arrivals of earlier probes
+            if len(receiver.recv(MAX_SEGMENT_SIZE)) == len(datagram):
+                return True
+    except OSError:
+        # The datagram was too large to send unfragmented, or did not arrive in time
+        return False
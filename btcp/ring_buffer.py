@@ -0,0 +1,64 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+# A preallocated circular buffer of bytes, used by the server to store in-order data until the application reads it.
+# Payloads are copied in straight from the received datagrams, and read out in chunks of any size,
+# such that neither side allocates per segment. The buffer is not thread-safe, so callers need to hold a lock.
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = memoryview(bytearray(capacity))
+        # Offset of the first unread byte, and the number of unread bytes
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # Number of bytes that can still be written
+    @property
+    def free(self):
+        return self.capacity - self.size
+
+    # Append the bytes-like `data`, which must fit in the free space
+    def write(self, data):
+        n = len(data)
+        if n > self.free:
+            raise BufferError(f"Cannot write {n} bytes to a ring buffer with {self.free} bytes free")
+        end = (self.start + self.size) % self.capacity if self.capacity else 0
+        # The data may wrap around the end of the buffer
+        first = min(n, self.capacity - end)
+        self.data[end:end + first] = data[:first]
+        self.data[:n - first] = data[first:]
+        self.size += n
+
+    # Copy at most `nbytes` unread bytes into the writable memoryview `view`, and return how many were copied
+    def read_into(self, view, nbytes):
+        n = min(nbytes, self.size, len(view))
+        first = min(n, self.capacity - self.start)
+        view[:first] = self.data[self.start:self.start + first]
+        view[first:n] = self.data[:n - first]
+        self.consume(n)
+        return n
+
+    # Read at most `nbytes` unread bytes, copying them once
+    def read(self, nbytes):
+        n = min(nbytes, self.size)
+        first = min(n, self.capacity - self.start)
+        if first == n:
+            out = bytes(self.data[self.start:self.start + n])
+        else:
+            out = b"".join((self.data[self.start:], self.data[:n - first]))
+        self.consume(n)
+        return out
+
+    def consume(self, n):
+        self.size -= n
+        # Start at the beginning once empty, such that reads are contiguous as often as possible
+        self.start = 0 if self.size == 0 else (self.start + n) % self.capacity
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
@@ -0,0 +1,37 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+from btcp.constants import *
+
+# Estimates the retransmission timeout (RTO) from measured round trip times,
+# following RFC 6298. All times are in seconds.
+class RTTEstimator:
+    def __init__(self, initial, minimum = MIN_TIMEOUT / 1000, maximum = MAX_TIMEOUT / 1000):
+        self.minimum = minimum
+        self.maximum = maximum
+        # Smoothed round trip time and round trip time variation, None until the first sample
+        self.srtt = None
+        self.rttvar = None
+        self._rto = max(minimum, min(initial, maximum))
+
+    @property
+    def rto(self):
+        return self._rto
+
+    # Update the estimate with a new round trip time measurement.
+    # Following Karn's rule, this should never be a measurement of a retransmitted segment.
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + max(CLOCK_GRANULARITY / 1000, 4 * self.rttvar)
+        self._rto = max(self.minimum, min(rto, self.maximum))
+
+    # Exponential backoff after a timeout. The next sample recomputes the RTO.
+    def backoff(self):
+        self._rto = min(self._rto * 2, self.maximum)
@@ -0,0 +1,23 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+# Serial number arithmetic (RFC 1982) on the 16 bit sequence numbers.
+# Sequence numbers wrap around, but as a window is far smaller than half of the sequence space,
+# the distance between two sequence numbers within a window is unambiguous.
+
+SEQUENCE_SPACE = 1 << 16
+HALF_SEQUENCE_SPACE = SEQUENCE_SPACE >> 1
+
+# The sequence number `n` segments after `seq_n`
+def seq_add(seq_n, n):
+    return (seq_n + n) % SEQUENCE_SPACE
+
+# The number of segments `b` is ahead of `a`, in 0 .. SEQUENCE_SPACE - 1
+def seq_distance(a, b):
+    return (b - a) % SEQUENCE_SPACE
+
+# The signed number of segments `b` is ahead of `a`, negative if `b` is behind `a`
+def seq_diff(a, b):
+    return (b - a + HALF_SEQUENCE_SPACE) % SEQUENCE_SPACE - HALF_SEQUENCE_SPACE
@@ -6,132 +6,491 @@
 import socket, random, time, threading, queue
 from btcp.lossy_layer import LossyLayer
 from btcp.btcp_socket import BTCPSocket
+from btcp.ring_buffer import RingBuffer
+from btcp.timer import TimerQueue
+from btcp.file_io import PreallocatedFile
+from btcp import trace
 from btcp.constants import *
-from btcp.btcp_segment import BTCPSegment, ACKSegment, SYNSegment, SYNACKSegment, FINSegment, FINACKSegment
+from btcp.btcp_segment import BTCPSegment, ACKSegment, SACKSegment, SYNSegment, SYNACKSegment, FINSegment, FINACKSegment
+from btcp.sequence import SEQUENCE_SPACE, HALF_SEQUENCE_SPACE, seq_add, seq_distance
 
 # The bTCP server socket
-# A server application makes use of the services provided by bTCP by calling accept, recv, and close
+# A server application makes use of the services provided by bTCP by calling listen, accept and close.
+# The server socket demultiplexes incoming segments by the address of the client into connections.
+# accept returns a BTCPServerConnection for every client, which the application reads from using recv.
 
-# States:
-# 0: Default
-# 1: Accepting
+# A connection with a single client, created by the server socket
+
+# Connection states:
+# 0: Terminated
 # 2: Sent SYNACK, waiting for ACK
 # 3: Connection established
 
-class BTCPServerSocket(BTCPSocket):
-    def __init__(self, window, timeout, debug):
-        super().__init__(window, timeout, debug, "Server")
-        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+class BTCPServerConnection(BTCPSocket):
+    def __init__(self, server, address):
+        super().__init__(server._window, server._timeout, server._debug, "Server")
+        self.server = server
+        self.address = address
+        # Events of the connection are recorded together with those of the server
+        self.tracer = server.tracer
+        self._lossy_layer = server._lossy_layer
+        # Whether the client accepted to receive SACK blocks, and segments without padding
+        self.sack_enabled = False
+        self.varlen_enabled = False
+        # The payload size agreed on with the client
+        self.payload_size = PAYLOAD_SIZE
         # Threading event for connections
         self._connection_event = threading.Event()
         self._disconnection_event = threading.Event()
         # Set default values
-        self.buffer = queue.Queue(window)
+        # In-order data that has not been read by the application yet, with room for `window` full segments.
+        # It is reallocated once the payload size has been negotiated.
+        self.buffer = RingBuffer(self._window * self.payload_size)
         self.last_sent_ack_n = None
         self.last_ack = None
+        # Number of in-order data segments that have not been acknowledged yet, as their ACK is delayed,
+        # and the ack_n of the most recent data segment, which the next ACK echoes as its seq_n
+        self.unacked = 0
+        self.ack_seq_n = 0
         self.receiving = True
-        self.mutex = threading.Lock()
-        self.stored_seq_n = []
+        # Set once the final segment has been delivered, or the connection is terminated,
+        # after which recv returns an empty bytes object once the buffer is exhausted
+        self.eof = False
+        # Guards the buffer. recv waits on it until data is delivered or the end of the data is reached.
+        self.mutex = threading.Condition()
+        # Out-of-order segments within the window, as a map from seq_n to (data_length, body)
+        self.out_of_order = {}
+        # Whether the last ACK advertised a window of 0
+        self.stalled = False
 
-    # Called by the lossy layer from another thread whenever a segment arrives
-    def lossy_layer_input(self, segment):
-        # Split segment into values
-        segment_data, (c_ip, c_port) = segment
-        # Unpack the segment into the corresponding values
-        seq_n, ack_n, flags_int, window, data_length, checksum, body = BTCPSegment.unpack(segment_data)
-        flags = BTCPSegment.convert_int_to_flags(flags_int)
-        # Check whether this segment should be discarded
-        out = BTCPSegment.get_checksum(segment_data)
-        if out != 0:
-            self.print("Corrupted Segment received. Discarding...")
-            return
-        
-        # If we are in the "accepting" state and flag is SYN
-        if (self.state == 1 or self.state == 2) and flags == {"SYN"}:
+    # Pack a segment and put it into the network, addressed to the client of this connection
+    def send_segment(self, segment):
+        packed = segment.pack(self.varlen_enabled, HEADER_SIZE + self.payload_size)
+        self.counters.segments_sent += 1
+        self.counters.bytes_sent += len(packed)
+        self.server.send_segment(packed, self.address)
+
+    # The counters, together with the state of the connection, the number of buffered bytes and out-of-order segments
+    def stats(self):
+        stats = super().stats()
+        stats.update(state=self.state, buffered=len(self.buffer), out_of_order_buffered=len(self.out_of_order))
+        return stats
+
+    # Called by the server socket for every valid segment from the client of this connection.
+    # `options` holds the OPTION_FLAGS of the segment, which are not part of `flags`.
+    def handle_segment(self, seq_n, ack_n, flags, options, data_length, body):
+        # A (possibly retransmitted) SYN while the handshake is in progress
+        if (self.state == 0 or self.state == 2) and flags == FLAG_SYN:
             # Set state to Sent SYNACK, waiting for ACK
             self.state = 2
-            new_seq_n = random.randrange(0, 65535)
-            new_ack_n = seq_n + 1
-            self._lossy_layer.send_segment(SYNACKSegment(new_seq_n, new_ack_n, self._window).pack())
-        
+            new_seq_n = random.randrange(0, SEQUENCE_SPACE)
+            new_ack_n = seq_add(seq_n, 1)
+            # The first data segment follows the SYN
+            self.last_sent_ack_n = new_ack_n
+            # Use SACK if the client is able to receive SACK blocks
+            self.sack_enabled = self.server.sack and bool(options & FLAG_SACK)
+            # Stop padding segments if the client is able to receive them
+            self.varlen_enabled = self.server.varlen and bool(options & FLAG_VARLEN)
+            # Use the largest payload size both we and the client would like to use
+            self.payload_size = min(BTCPSegment.unpack_payload_size(body, data_length), self.server.max_payload_size)
+            if self.buffer.capacity != self._window * self.payload_size:
+                self.buffer = RingBuffer(self._window * self.payload_size)
+            self.send_segment(SYNACKSegment(new_seq_n, new_ack_n, self._window, self.sack_enabled, self.varlen_enabled,
+                                            self.payload_size))
+
         # If we are in the "Sent SYNACK, waiting for ACK" state and flag is ACK
-        elif self.state == 2 and flags == {"ACK"}:
-            # Set state to Connection established
-            self.state = 3
-            # Stop accept() waiting
-            self._connection_event.set()
-            self.print("-= Connection Established =-")
+        elif self.state == 2 and flags == FLAG_ACK:
+            self.establish()
 
         # If the client wants to disconnect, and sends a FIN
         # Only respond if connected or attempting to connect
-        elif flags == {"FIN"} and (self.state == 2 or self.state == 3):
+        elif flags == FLAG_FIN and (self.state == 2 or self.state == 3):
             if self._connection_event.is_set():
                 self.print("-= Connection Terminated =-")
             # Set state to closed connection
             self.state = 0
             self._connection_event.clear()
             self._disconnection_event.set()
+            self.set_eof()
             # And send FINACK
-            segment = FINACKSegment(self._window)
-            self._lossy_layer.send_segment(segment.pack())
-        
+            self.send_segment(FINACKSegment(self._window))
+
         # If the segment has no flags, it is data
-        elif flags == set():
-            # Only respond if this segment is the first, or follows a previously acked segment
-            if (self.last_sent_ack_n is None and seq_n == 0) or seq_n == self.last_sent_ack_n:
-                # Get new sequence numbers and acknowledgement numbers for the ACK
-                new_seq_n = ack_n
-                new_ack_n = (seq_n + data_length) % 65535
-                # Store the new_ack_n, as the next segment from the client should have that value as its seq_n.
-                self.last_sent_ack_n = new_ack_n
-                
-                # If the data length is 65534, then this is the final segment.
-                if data_length == 65534:
-                    if self.receiving:
-                        self.print("Final segment received.")
-                        self.receiving = False
+        elif flags == 0 and (self.state == 2 or self.state == 3):
+            # If the final ACK of the handshake was lost, the data shows that the client is connected
+            if self.state == 2:
+                self.establish()
+            # Every segment follows the previously acked segment, or the SYN for the first segment
+            expected = self.last_sent_ack_n
+            # Whether the ACK for this segment may be delayed
+            delay = False
+            # Number of full segments we can still store in the buffer
+            free = self.free_segments()
+            # Number of segments this segment is ahead of the one we expect.
+            # Old, duplicate segments are (far) behind, and hence get a large distance.
+            distance = seq_distance(expected, seq_n)
+
+            if distance == 0 and free > 0:
+                # The segment we expected: deliver it, followed by any buffered
+                # out-of-order segments that are now in order
+                expected = self.deliver(seq_n, data_length, body)
+                filled = expected in self.out_of_order
+                # Out-of-order segments were only stored if they fit in the window, so they still fit in the buffer
+                while expected in self.out_of_order:
+                    expected = self.deliver(expected, *self.out_of_order.pop(expected))
+                # Store the expected seq_n, as the next segment from the client should have that value as its seq_n.
+                self.last_sent_ack_n = expected
+                self.unacked += 1
+                # Delay the ACK until enough segments are unacknowledged. Acknowledge immediately if this
+                # segment filled a gap, if there still is a gap, or if it was the final segment.
+                delay = self.unacked < self.server.ack_every and not filled and not self.out_of_order and self.receiving
+
+            elif distance == 0:
+                # The segment we expected, but the application has not read enough to make room for it
+                self.counters.window_drops += 1
+
+            elif 0 < distance < free:
+                # If this segment is out of order, but fits in the window, store it until the gap is filled
+                if seq_n in self.out_of_order:
+                    self.counters.duplicate_segments += 1
                 else:
-                    # Otherwise, store the body in the buffer
-                    with self.mutex:
-                        self.buffer.put_nowait(body[:data_length])
-                
-                # Send the new ACK
-                self.last_ack = ACKSegment(new_seq_n, new_ack_n, self._window - self.buffer.qsize())
-                self._lossy_layer.send_segment(self.last_ack.pack())
-            
+                    self.counters.out_of_order += 1
+                    self.out_of_order[seq_n] = (data_length, body)
+
+            elif distance < HALF_SEQUENCE_SPACE:
+                # This segment is ahead, but there is no room for it in the window
+                self.counters.out_of_order_drops += 1
             else:
-                # If this segment is out of order, duplicated or something similar
-                # eg, it isn't the segment we expect, then we send the last acknowledged segment.
-                if self.last_ack:
-                    self._lossy_layer.send_segment(self.last_ack.pack())
-
-    # Wait for the client to initiate a three-way handshake
-    def accept(self, blocked = True):
-        # Set the state to 1, which lossy_layer_input can use to accept connection requests
-        # from the client. By default wait until we are properly connected.
-        self.state = 1
-        if blocked:
-            self._connection_event.wait()
-
-    # Send any incoming data to the application layer
-    def recv(self):
-        # Get value from buffer, unless empty, and only if the state is connected.
-        # If not connected, throw an exception.
-        if self.state == 3 or not self.buffer.empty():
-            try:
-                with self.mutex:
-                    return self.buffer.get_nowait()
-            except queue.Empty:
-                return bytearray()
-        return bytearray()
+                self.counters.duplicate_segments += 1
+
+            self.ack_seq_n = ack_n
+            if delay:
+                self.server.delay_ack(self)
+            else:
+                self.send_ack()
+
+    # Send a (possibly duplicate) cumulative ACK for the segment we expect next.
+    # Duplicate ACKs let the client know which segment is missing.
+    # If enabled, also tell the client exactly which out-of-order segments we have.
+    def send_ack(self):
+        self.unacked = 0
+        expected = self.last_sent_ack_n
+        if self.sack_enabled and self.out_of_order:
+            self.last_ack = SACKSegment(self.ack_seq_n, expected, self.free_segments(), self.sack_blocks(expected))
+        else:
+            self.last_ack = ACKSegment(self.ack_seq_n, expected, self.free_segments())
+        # Count the times that the window closes, because the application does not read fast enough
+        if self.last_ack.window == 0 and not self.stalled:
+            self.counters.window_stalls += 1
+        self.stalled = self.last_ack.window == 0
+        self.send_segment(self.last_ack)
+
+    # The window to advertise: the number of full segments that fit in the free space of the buffer
+    def free_segments(self):
+        return self.buffer.free // self.payload_size
+
+    # Complete the three-way handshake, and hand the connection to accept
+    def establish(self):
+        # Set state to Connection established
+        self.state = 3
+        self._connection_event.set()
+        self.print("-= Connection Established =-")
+        self.server.established(self)
+
+    # Get at most MAX_SACK_BLOCKS (start, end) blocks of consecutive out-of-order segments,
+    # starting with the blocks closest to the expected segment
+    def sack_blocks(self, expected):
+        blocks = []
+        for distance in sorted(seq_distance(expected, seq_n) for seq_n in self.out_of_order):
+            if blocks and blocks[-1][1] == distance:
+                blocks[-1][1] = distance + 1
+            elif len(blocks) < MAX_SACK_BLOCKS:
+                blocks.append([distance, distance + 1])
+            else:
+                break
+        return [(seq_add(expected, start), seq_add(expected, end)) for start, end in blocks]
+
+    # Deliver an in-order segment to the buffer, and return the sequence number of the next segment
+    def deliver(self, seq_n, data_length, body):
+        # If the data length is 65534, then this is the final segment.
+        if data_length == 65534:
+            if self.receiving:
+                self.print("Final segment received.")
+                self.receiving = False
+                self.set_eof()
+        else:
+            # Otherwise, copy the body from the datagram into the buffer, and wake up a waiting recv
+            with self.mutex:
+                self.buffer.write(body[:data_length])
+                self.mutex.notify()
+        return seq_add(seq_n, 1)
+
+    # Signal that no more data will be delivered
+    def set_eof(self):
+        with self.mutex:
+            self.eof = True
+            self.mutex.notify_all()
+
+    # Send any incoming data to the application layer.
+    # Blocks until data is available, and returns at most `max_bytes` bytes, or all buffered data
+    # if `max_bytes` is None. An empty bytes object is returned once all data has been received.
+    # Raises a TimeoutError if no data arrives within `timeout` seconds.
+    def recv(self, max_bytes = None, timeout = None):
+        with self.mutex:
+            if not self.wait_readable(timeout):
+                return b""
+            data = self.buffer.read(len(self.buffer) if max_bytes is None else max_bytes)
+        self.update_window()
+        return data
+
+    # Like recv, but copies the data directly into `buffer`, a writable bytes-like object.
+    # Returns the number of bytes written, which is 0 once all data has been received.
+    def recv_into(self, buffer, nbytes = 0, timeout = None):
+        view = memoryview(buffer).cast("B")
+        nbytes = nbytes or len(view)
+        with self.mutex:
+            if not self.wait_readable(timeout):
+                return 0
+            n = self.buffer.read_into(view, nbytes)
+        self.update_window()
+        return n
+
+    # If the last ACK advertised a window of 0, and reading has made room for a segment, send an ACK with the new
+    # window. Otherwise, the client only learns that the window opened up once its window probe is acknowledged.
+    # The ACK condition of the server is taken before the mutex everywhere, so this is called after releasing the mutex.
+    def update_window(self):
+        if self.stalled:
+            with self.server.ack_condition:
+                if self.stalled and self.free_segments() > 0:
+                    self.send_ack()
+
+    # Write all data from the client to the file at `path`, and return the number of bytes written.
+    # The file is preallocated and memory-mapped `chunk_size` bytes at a time, and the data is copied straight from
+    # the receive buffer into the mapped file, in as large reads as are available.
+    def recv_file(self, path, chunk_size = FILE_CHUNK_SIZE, timeout = None):
+        with PreallocatedFile(path, chunk_size) as f:
+            n = None
+            while n != 0:
+                with f.next_chunk() as view:
+                    filled = 0
+                    while filled < len(view):
+                        n = self.recv_into(view[filled:], timeout=timeout)
+                        if n == 0:
+                            break
+                        filled += n
+                        f.size += n
+        return f.size
+
+    # Wait until the buffer holds data, and return whether it does. Returns False at the end of the data.
+    # Must be called while holding self.mutex.
+    def wait_readable(self, timeout):
+        if not self.mutex.wait_for(lambda: self.buffer or self.eof, timeout):
+            raise TimeoutError("No data received within the timeout")
+        return bool(self.buffer)
 
     # Clean up any state
     def close(self):
-        # Reset all variables to defaults
+        # Export a final snapshot of the counters before the state is reset
+        self.stop_exporting()
+        if self.tracer is not None:
+            self.tracer.record(trace.RESET, port=self.address[1])
+        # Reset all variables to defaults, and wake up the application if it is still waiting for data
         self._connection_event.clear()
         self.state = 0
-        self.stored_seq_n = []
+        self.out_of_order = {}
+        self.sack_enabled = False
+        self.varlen_enabled = False
+        self.payload_size = PAYLOAD_SIZE
         self.last_ack = None
-        self.buffer.empty()
+        self.unacked = 0
+        with self.mutex:
+            self.buffer.clear()
+            self.eof = True
+            self.mutex.notify_all()
+        self.server.connections.pop(self.address, None)
+
+
+# Server socket states:
+# 0: Default
+# 1: Listening
+
+class BTCPServerSocket(BTCPSocket):
+    # The class of the connections returned by accept
+    connection_class = BTCPServerConnection
+
+    def __init__(self, window, timeout, debug, sack = True, lossy_layer = LossyLayer, varlen = True,
+                 payload_size = PAYLOAD_SIZE, ack_every = DELAYED_ACK_SEGMENTS, ack_delay = DELAYED_ACK_TIMEOUT):
+        super().__init__(window, timeout, debug, "Server")
+        # Whether we are willing to send SACK blocks, and segments without padding
+        self.sack = sack
+        self.varlen = varlen
+        # The largest payload size we are willing to receive
+        if not MIN_PAYLOAD_SIZE <= payload_size <= MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Payload size {payload_size} is not between {MIN_PAYLOAD_SIZE} and {MAX_PAYLOAD_SIZE}")
+        self.max_payload_size = payload_size
+        # The lossy layer is created through a factory with the signature of LossyLayer, so it can be replaced
+        self._lossy_layer = lossy_layer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+        # Map from client address to its connection
+        self.connections = {}
+        # Established connections that have not been returned by accept yet
+        self.accepted = queue.Queue()
+        # Segments to send once the current batch of incoming segments is handled, per client address
+        self.outgoing = None
+        # Acknowledge every `ack_every` in-order segments, or `ack_delay` milliseconds after the first unacknowledged one.
+        # An `ack_every` of 1 acknowledges every segment immediately.
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        # Timers of the connections with delayed ACKs. Connections with delayed ACKs in the current batch
+        # are kept separately, until their timers are started at the end of the batch.
+        self.delayed_acks = TimerQueue()
+        self.batch_acks = {}
+        # Guards the handling of incoming segments, such that the timer thread can send delayed ACKs in between
+        self.ack_condition = threading.Condition()
+        self.ack_thread = None
+        self.closed = False
+
+    # Called by the lossy layer from another thread whenever a segment arrives
+    def lossy_layer_input(self, segment, verified = False):
+        # Split segment into values
+        segment_data, address = segment
+        # Unpack the segment into the corresponding values
+        # Discard datagrams that are too short to hold a header
+        if len(segment_data) < HEADER_SIZE:
+            return
+        # Check whether this segment should be discarded, unless that was already done for its batch
+        if not verified and not self.verify(segment_data):
+            return
+        seq_n, ack_n, flags, window, data_length, checksum, body = BTCPSegment.unpack(segment_data)
+        if self.tracer is not None:
+            self.tracer.record(trace.RX, flags, seq_n, ack_n, window, data_length, address[1])
+        options = flags & OPTION_FLAGS
+        flags &= ~OPTION_FLAGS
+
+        connection = self.connections.get(address)
+        if connection is None:
+            # A SYN from a new client starts a new connection, if we are listening
+            if flags == FLAG_SYN and self.state == 1:
+                connection = self.connection_class(self, address)
+                self.connections[address] = connection
+            # A FIN for a connection that is already terminated means our FINACK got lost.
+            # We no longer know whether the client accepts segments without padding, so the FINACK is padded.
+            elif flags == FLAG_FIN:
+                self.send_segment(FINACKSegment(self._window).pack(), address)
+                return
+            else:
+                return
+
+        connection.counters.segments_received += 1
+        connection.counters.bytes_received += len(segment_data)
+        connection.handle_segment(seq_n, ack_n, flags, options, data_length, body)
+        # Forget terminated connections
+        if connection.state == 0:
+            self.connections.pop(address, None)
+
+    # Handle a batch of incoming segments, and send all responses afterwards in batches per client.
+    # Delayed ACKs are only scheduled at the end of the batch, as later segments in the batch may already trigger them.
+    def lossy_layer_input_batch(self, segments):
+        with self.ack_condition:
+            self.outgoing = {}
+            try:
+                super().lossy_layer_input_batch(segments)
+                batch_acks, self.batch_acks = self.batch_acks, {}
+                for connection in batch_acks:
+                    if connection.unacked:
+                        self.start_ack_timer(connection)
+            finally:
+                outgoing, self.outgoing = self.outgoing, None
+                for address, batch in outgoing.items():
+                    self._lossy_layer.send_segments(batch, address)
+
+    # Acknowledge the in-order segments of `connection` once the delay has passed, unless more segments arrive first
+    def delay_ack(self, connection):
+        if self.outgoing is not None:
+            self.batch_acks[connection] = None
+        else:
+            self.start_ack_timer(connection)
+
+    # Send the ACK of `connection` once the delay has passed, unless it is sent before that
+    def start_ack_timer(self, connection):
+        if connection not in self.delayed_acks:
+            with self.ack_condition:
+                self.delayed_acks.arm(connection, time.monotonic())
+                if self.ack_thread is None:
+                    self.ack_thread = threading.Thread(target=self.send_delayed_acks, daemon=True)
+                    self.ack_thread.start()
+                self.ack_condition.notify()
+
+    # Run by the timer thread: send the delayed ACKs once they are due, until the socket is closed
+    def send_delayed_acks(self):
+        delay = self.ack_delay / 1000
+        with self.ack_condition:
+            while not self.closed:
+                now = time.monotonic()
+                for connection in self.delayed_acks.pop_expired(now, delay):
+                    # The ACK may have been sent in the meantime, e.g. because a gap appeared
+                    if connection.unacked:
+                        connection.send_ack()
+                first = self.delayed_acks.first()
+                self.ack_condition.wait(None if first is None else self.delayed_acks.remaining(first[0], now, delay))
+
+    # Put a segment into the network, or queue it if a batch of incoming segments is being handled
+    def send_segment(self, segment, address):
+        self.counters.segments_sent += 1
+        self.counters.bytes_sent += len(segment)
+        if self.tracer is not None:
+            self.tracer.segment(trace.TX, segment, address[1])
+        if self.outgoing is None:
+            self._lossy_layer.send_segment(segment, address)
+        else:
+            self.outgoing.setdefault(address, []).append(segment)
+
+    # The counters of the whole socket, together with those of every connection, by client address
+    def stats(self):
+        stats = super().stats()
+        stats["connections"] = {f"{ip}:{port}": connection.stats() for (ip, port), connection in list(self.connections.items())}
+        return stats
+
+    # Record the events of this socket and all of its connections into a single ring buffer
+    def enable_tracing(self, capacity = 1 << 16):
+        tracer = super().enable_tracing(capacity)
+        for connection in list(self.connections.values()):
+            connection.tracer = tracer
+        return tracer
+
+    # Called by a connection once the three-way handshake has completed
+    def established(self, connection):
+        self.accepted.put(connection)
+
+    # Start accepting connection requests from clients
+    def listen(self):
+        self.state = 1
+
+    # Wait for a client to complete a three-way handshake, and return the new connection.
+    # Raises a TimeoutError if no client connects within `timeout` seconds.
+    def accept(self, timeout = None):
+        if self.state != 1:
+            self.listen()
+        try:
+            return self.accepted.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No connection accepted within the timeout")
+
+    # Clean up any state
+    def close(self):
+        self.stop_exporting()
+        # Stop the timer thread of the delayed ACKs
+        with self.ack_condition:
+            self.closed = True
+            self.delayed_acks.clear()
+            self.ack_condition.notify()
+        if self.ack_thread is not None and self.ack_thread is not threading.current_thread():
+            self.ack_thread.join()
+        self.ack_thread = None
+        # Terminate all connections, waking up any application waiting on them
+        self.state = 0
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.connections = {}
+        self.accepted = queue.Queue()
         # Destroy lossy layer thread
         self._lossy_layer.destroy()
@@ -0,0 +1,77 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import bisect, threading
+
+# Counters kept by every socket and connection. They are plain integer attributes, such that counting is cheap,
+# and are read through BTCPSocket.stats(), which returns a snapshot as a dict.
+# Counters that do not apply to a socket, such as retransmissions on the server, remain 0.
+
+# Upper bounds of the buckets of the RTT histogram in milliseconds, followed by a bucket for anything larger
+RTT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Statistics:
+    COUNTERS = (
+        "segments_sent",
+        "bytes_sent",
+        "segments_received",
+        "bytes_received",
+        # Segments discarded because of an invalid checksum
+        "corrupted",
+        # Client: retransmitted segments, split by what triggered them.
+        # Fast retransmissions are triggered by duplicate ACKs, SACK blocks or partial ACKs.
+        "retransmissions_timeout",
+        "retransmissions_fast",
+        "duplicate_acks",
+        # Client: times that sending stopped because the window advertised by the server was full.
+        # Server: times that a window of 0 was advertised, because the application did not read fast enough.
+        "window_stalls",
+        # Client: segments resent to probe a window of 0, because a timeout hit while the server's window was closed
+        "window_probes",
+        # Server: data segments that arrived ahead of the expected one and were buffered,
+        # that arrived ahead but did not fit in the window and were dropped, and that were received before
+        "out_of_order",
+        "out_of_order_drops",
+        "duplicate_segments",
+        # Server: expected data segments that were dropped, because the buffer was full
+        "window_drops",
+    )
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.rtt_histogram = [0] * (len(RTT_BUCKETS) + 1)
+
+    def add_rtt(self, seconds):
+        self.rtt_histogram[bisect.bisect_left(RTT_BUCKETS, seconds * 1000)] += 1
+
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.COUNTERS}
+        labels = [f"<={bound}ms" for bound in RTT_BUCKETS] + [f">{RTT_BUCKETS[-1]}ms"]
+        snapshot["rtt_histogram"] = dict(zip(labels, self.rtt_histogram))
+        return snapshot
+
+
+# Calls `callback(sock.stats())` every `interval` seconds from a background thread, until stopped
+class StatsExporter:
+    def __init__(self, sock, callback, interval):
+        self._sock = sock
+        self._callback = callback
+        self._interval = interval
+        self._event = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while not self._event.wait(self._interval):
+            self._callback(self._sock.stats())
+
+    # Stop exporting, after exporting a final snapshot
+    def stop(self):
+        if not self._event.is_set():
+            self._event.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._callback(self._sock.stats())
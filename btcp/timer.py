@@ -0,0 +1,55 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import collections
+
+# A queue of timers that all expire the same timeout after they were (re)armed. Timers are kept in the order in
+# which they were armed, so the first one always expires first, and arming, cancelling and finding the next
+# timer to expire are O(1). The timeout is passed when checking for expiry, such that it may change over time,
+# like the retransmission timeout. Used for the retransmissions of the client, and the delayed ACKs of the server.
+class TimerQueue:
+    def __init__(self):
+        # Map from key to the time at which its timer was armed
+        self.timers = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    # (Re)arm the timer of `key` at time `now`
+    def arm(self, key, now):
+        self.timers[key] = now
+        self.timers.move_to_end(key)
+
+    def cancel(self, key):
+        self.timers.pop(key, None)
+
+    # The time at which the timer of `key` was armed, or None if it is not armed
+    def armed_at(self, key):
+        return self.timers.get(key)
+
+    # The (key, time armed) of the timer that expires first, or None if no timer is armed
+    def first(self):
+        return next(iter(self.timers.items()), None)
+
+    # Remove and return the keys of the timers that have expired at time `now`, in order
+    def pop_expired(self, now, timeout):
+        expired = []
+        while self.timers:
+            key, armed = next(iter(self.timers.items()))
+            if armed + timeout > now:
+                break
+            self.timers.popitem(last=False)
+            expired.append(key)
+        return expired
+
+    # The number of seconds until the timer of `key` expires, which is negative once it has expired
+    def remaining(self, key, now, timeout):
+        return self.timers[key] + timeout - now
+
+    def clear(self):
+        self.timers.clear()
@@ -0,0 +1,79 @@
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import struct, threading, time
+from btcp.btcp_segment import HEADER
+
+# Binary tracing of protocol events into a preallocated ring buffer.
+# Sockets only record events once tracing is enabled with `sock.enable_tracing()`, such that tracing costs
+# a single attribute check when disabled. Once the ring buffer is full, the oldest events are overwritten.
+# A trace can be dumped to a file, and turned into a timeline or plot with trace_tool.py.
+
+# Event types
+TX = 1
+RX = 2
+RETRANSMIT = 3
+STATE = 4
+TIMEOUT = 5
+CORRUPT = 6
+RESET = 7
+EVENT_NAMES = {TX: "TX", RX: "RX", RETRANSMIT: "RETRANSMIT", STATE: "STATE", TIMEOUT: "TIMEOUT", CORRUPT: "CORRUPT", RESET: "RESET"}
+
+# time, event, flags, seq_n, ack_n, window, length and port.
+# For segments, these are the header fields, the length of the data and the port of the other side,
+# which is 0 for segments sent by the client, as it only has one.
+# For STATE events, length holds the new state, and for TIMEOUT events, seq_n holds the sequence number of the
+# segment that timed out and length the retransmission timeout in milliseconds.
+EVENT = struct.Struct("<dBBHHHHH")
+MAGIC = b"BTCPTRC1"
+FILE_HEADER = struct.Struct("<8sII")
+
+class Tracer:
+    def __init__(self, capacity = 1 << 16):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * EVENT.size)
+        # Number of events recorded so far. Events are recorded from several threads, so the lock is held while
+        # claiming and writing a slot, and while reading the events, such that no slot is read half written.
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, event, flags = 0, seq_n = 0, ack_n = 0, window = 0, length = 0, port = 0):
+        with self.lock:
+            EVENT.pack_into(self.buffer, (self.count % self.capacity) * EVENT.size,
+                            time.time(), event, flags, seq_n, ack_n, window, min(length, 0xffff), port)
+            self.count += 1
+
+    # Record a packed segment
+    def segment(self, event, segment, port = 0):
+        seq_n, ack_n, flags, window, data_length, checksum = HEADER.unpack_from(segment)
+        self.record(event, flags, seq_n, ack_n, window, data_length, port)
+
+    # Record a batch of packed segments
+    def segments(self, event, segments, port = 0):
+        for segment in segments:
+            self.segment(event, segment, port)
+
+    # The recorded events in chronological order, as tuples of the EVENT fields
+    def events(self):
+        with self.lock:
+            start = max(self.count - self.capacity, 0)
+            return [EVENT.unpack_from(self.buffer, (i % self.capacity) * EVENT.size) for i in range(start, self.count)]
+
+    # Write the recorded events to a file, oldest first
+    def dump(self, path):
+        events = self.events()
+        with open(path, "wb") as f:
+            f.write(FILE_HEADER.pack(MAGIC, EVENT.size, len(events)))
+            for event in events:
+                f.write(EVENT.pack(*event))
+
+# Read the events from a file written by Tracer.dump
+def load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, size, count = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or size != EVENT.size:
+        raise ValueError(f"{path} is not a bTCP trace")
+    return [event for event in EVENT.iter_unpack(data[FILE_HEADER.size:FILE_HEADER.size + count * size])]
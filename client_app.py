@@ -4,31 +4,66 @@
 # Bart Janssen - s4630270
 # ------------------------
 
-import argparse, time
+import argparse, time, csv, json, sys
 from btcp.client_socket import BTCPClientSocket
+from btcp.lossy_layer import probe_payload_size
+from btcp.constants import *
+from btcp import congestion
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--window", help="Define bTCP window size", type=int, default=100)
-    parser.add_argument("-t", "--timeout", help="Define bTCP timeout in milliseconds", type=int, default=300)
-    parser.add_argument("-d", "--debug", help="Whether to print debugging statements", type=int, default=True)
+    parser.add_argument("-t", "--timeout", help="Define the initial bTCP retransmission timeout in milliseconds, it adapts to the measured round trip time", type=int, default=300)
+    parser.add_argument("-d", "--debug", help="Whether to print debugging statements", type=int, default=False)
     parser.add_argument("-r", "--retries", help="How many times to retry connecting/disconnecting", default=10)
     parser.add_argument("-i", "--input", help="File to send", default="input.file")
+    parser.add_argument("-s", "--sack", help="Whether to use selective acknowledgements", type=int, default=True)
+    parser.add_argument("-l", "--varlen", help="Whether to send segments without padding, if the other side supports it", type=int, default=True)
+    parser.add_argument("-p", "--payload-size", help="Largest payload size in bytes to negotiate", type=int, default=PAYLOAD_SIZE)
+    parser.add_argument("-P", "--probe", help="Whether to probe for the largest payload size that gets through unfragmented", type=int, default=False)
+    parser.add_argument("--stats", help="Interval in seconds at which to print statistics as JSON to stderr, 0 to disable", type=float, default=0)
+    parser.add_argument("--trace", help="File to write a binary trace of the protocol events to, see trace_tool.py", default=None)
+    parser.add_argument("--trace-size", help="Number of most recent events kept in the trace", type=int, default=1 << 16)
+    parser.add_argument("-c", "--congestion", help="Congestion control algorithm", choices=sorted(congestion.ALGORITHMS), default="cubic")
+    parser.add_argument("--cwnd-log", help="CSV file to write the congestion window over time to", default=None)
     args = parser.parse_args()
 
+    # The server runs locally, so its address can be probed directly
+    payload_size = probe_payload_size(SERVER_IP) if args.probe else args.payload_size
+
     # Create a bTCP client socket with the given window size and timeout value
-    socket = BTCPClientSocket(args.window, args.timeout, args.debug, args.retries)
+    socket = BTCPClientSocket(args.window, args.timeout, args.debug, args.retries, args.sack, args.congestion,
+                              varlen=args.varlen, payload_size=payload_size)
     
+    # Periodically print the statistics, and a final snapshot when the socket is closed
+    if args.stats:
+        socket.export_stats(lambda stats: print(json.dumps(stats), file=sys.stderr), args.stats)
+    if args.trace:
+        socket.enable_tracing(args.trace_size)
+    if args.cwnd_log:
+        socket.enable_congestion_history()
+
     socket.connect()
 
-    with open(args.input, "r") as f:
-        socket.send(f)
+    socket.send_file(args.input)
 
     socket.disconnect()
 
+    # Write the congestion window history, with times relative to the start of the transfer
+    if args.cwnd_log:
+        history = socket.congestion.history
+        with open(args.cwnd_log, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "cwnd", "ssthresh"])
+            for timestamp, cwnd, ssthresh in history:
+                writer.writerow([f"{timestamp - history[0][0]:.6f}", f"{cwnd:.2f}", f"{ssthresh:.2f}"])
+
     # Clean up any state
     socket.close()
 
+    if args.trace:
+        socket.tracer.dump(args.trace)
+
 
 main()
@@ -4,34 +4,67 @@
 # Bart Janssen - s4630270
 # ------------------------
 
-import argparse, time, threading
+import argparse, time, threading, json, sys
 from btcp.server_socket import BTCPServerSocket
+from btcp.lossy_layer import probe_payload_size
+from btcp.constants import *
+
+
+# Write or override the output file with data from the connection until the end of the data is reached
+def receive(connection, output):
+    connection.recv_file(output)
+    # Wait a bit before closing, client might be able to disconnect gracefully,
+    # and normally a server wouldn't just shut down immediately after receiving data.
+    connection._disconnection_event.wait(timeout=5)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--window", help="Define bTCP window size", type=int, default=100)
     parser.add_argument("-t", "--timeout", help="Define bTCP timeout in milliseconds", type=int, default=300)
-    parser.add_argument("-d", "--debug", help="Whether to print output", type=int, default=True)
+    parser.add_argument("-d", "--debug", help="Whether to print output", type=int, default=False)
     parser.add_argument("-o", "--output", help="Where to store the file", default="output.file")
+    parser.add_argument("-s", "--sack", help="Whether to use selective acknowledgements", type=int, default=True)
+    parser.add_argument("-l", "--varlen", help="Whether to send segments without padding, if the other side supports it", type=int, default=True)
+    parser.add_argument("-p", "--payload-size", help="Largest payload size in bytes to negotiate", type=int, default=PAYLOAD_SIZE)
+    parser.add_argument("-P", "--probe", help="Whether to probe for the largest payload size that gets through unfragmented", type=int, default=False)
+    parser.add_argument("--stats", help="Interval in seconds at which to print statistics as JSON to stderr, 0 to disable", type=float, default=0)
+    parser.add_argument("--trace", help="File to write a binary trace of the protocol events to, see trace_tool.py", default=None)
+    parser.add_argument("--trace-size", help="Number of most recent events kept in the trace", type=int, default=1 << 16)
+    parser.add_argument("-a", "--ack-every", help="Number of in-order segments to acknowledge with a single ACK, 1 to acknowledge every segment", type=int, default=DELAYED_ACK_SEGMENTS)
+    parser.add_argument("--ack-delay", help="Time in milliseconds after which a delayed ACK is sent", type=int, default=DELAYED_ACK_TIMEOUT)
+    parser.add_argument("-n", "--clients", help="Number of clients to accept", type=int, default=1)
     args = parser.parse_args()
 
+    # Probe the local address we receive on
+    payload_size = probe_payload_size(SERVER_IP) if args.probe else args.payload_size
+
     # Create a bTCP server socket
-    socket = BTCPServerSocket(args.window, args.timeout, args.debug)
-
-    # Wait for connection from client
-    socket.accept()
-    
-    # Write or override output file with new data until buffer is empty 
-    # and server socket is no longer receiving data
-    with open(args.output, "w+") as f:
-        while socket.receiving or not socket.buffer.empty():
-            f.write(socket.recv().decode())
-    # Wait a bit before closing, client might be able to disconnect gracefully, 
-    # and normally a server wouldn't just shut down immediately after receiving data.
-    socket._disconnection_event.wait(timeout=5)
-    
+    socket = BTCPServerSocket(args.window, args.timeout, args.debug, args.sack, varlen=args.varlen, payload_size=payload_size,
+                              ack_every=args.ack_every, ack_delay=args.ack_delay)
+
+    # Periodically print the statistics, and a final snapshot when the socket is closed
+    if args.stats:
+        socket.export_stats(lambda stats: print(json.dumps(stats), file=sys.stderr), args.stats)
+    if args.trace:
+        socket.enable_tracing(args.trace_size)
+
+    # Accept the given number of clients, each in their own thread.
+    # With more than one client, the output of the i-th client is stored in `<output>.<i>`.
+    threads = []
+    for i in range(args.clients):
+        connection = socket.accept()
+        output = args.output if args.clients == 1 else f"{args.output}.{i}"
+        thread = threading.Thread(target=receive, args=(connection, output))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
     # Clean up any state
     socket.close()
 
+    if args.trace:
+        socket.tracer.dump(args.trace)
+
 main()
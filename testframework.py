@@ -7,6 +7,12 @@ import unittest, threading
 import socket
 import time
 import sys
+import os
+import random
+import tempfile
+import mmap
+import asyncio
+from unittest import mock
 
 timeout = 300
 winsize = 100
@@ -48,8 +54,20 @@ def run_command(command,cwd=None, shell=True):
     if process.returncode:
         print("2. problem running command : \n   ", str(command), " ", process.returncode)
 
-from btcp.server_socket import BTCPServerSocket
-from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket, BTCPServerConnection
+from btcp.client_socket import BTCPClientSocket, iter_payloads
+from btcp.aio import AsyncBTCPClientSocket, AsyncBTCPServerSocket
+from btcp.btcp_segment import BTCPSegment, ACKSegment, SACKSegment, SYNSegment
+from btcp import checksum
+from btcp.rtt import RTTEstimator
+from btcp.lossy_layer import LossyLayer, probe_payload_size
+from btcp import lossy_layer
+from btcp.emulator import EmulatedNetwork, NetworkConditions, Link
+from btcp import congestion, trace
+from btcp.sequence import seq_add, seq_distance, seq_diff
+from btcp.ring_buffer import RingBuffer
+from btcp.timer import TimerQueue
+from btcp.constants import *
 
 class TestbTCPFramework(unittest.TestCase):
     """Test cases for bTCP"""
@@ -58,10 +76,11 @@ class TestbTCPFramework(unittest.TestCase):
         """Prepare for testing"""
         # default netem rule (does nothing)
         run_command(netem_add)
+        self.lossy_layer = LossyLayer
         
         # launch localhost server
-        self.serv_socket = BTCPServerSocket(args.window, args.timeout, args.debug)
-        self.serv_socket.accept(blocked=False)
+        self.serv_socket = BTCPServerSocket(args.window, args.timeout, args.debug, lossy_layer=self.lossy_layer)
+        self.serv_socket.listen()
 
     def tearDown(self):
         """Clean up after testing"""
@@ -71,17 +90,24 @@ class TestbTCPFramework(unittest.TestCase):
         # close server
         self.serv_socket.close()
 
+    def change_network(self, rule):
+        """apply a netem rule to the network"""
+        run_command(netem_change.format(rule))
+
     def _test_ideal_network(self, msg, a):
         # server receives content from client
-        self.serv_socket._connection_event.wait()
-        while self.serv_socket.receiving or not self.serv_socket.buffer.empty():
-            a += self.serv_socket.recv()
+        connection = self.serv_socket.accept()
+        while True:
+            data = connection.recv()
+            if not data:
+                break
+            a += data
 
     def test_ideal_network(self, msg="Over ideal network"):
         """reliability over an ideal framework"""
         # setup environment (nothing to set)
         # launch localhost client connecting to server
-        client_socket = BTCPClientSocket(args.window, args.timeout, args.debug, args.retries)
+        client_socket = BTCPClientSocket(args.window, args.timeout, args.debug, args.retries, lossy_layer=self.lossy_layer)
         client_socket.connect()
         
         # Sleep a bit before starting a thread
@@ -92,7 +118,7 @@ class TestbTCPFramework(unittest.TestCase):
         t.start()
 
         # client sends content to server
-        with open("input.file", "r") as f:
+        with open("input.file", "rb") as f:
             client_socket.send(f)
         
         # Join the thread to wait until we are done filling a
@@ -106,39 +132,965 @@ class TestbTCPFramework(unittest.TestCase):
         # reliability over network with bit flips 
         # (which sometimes results in lower layer packet loss)
         # setup environment
-        run_command(netem_change.format("corrupt 1%"))
+        self.change_network("corrupt 1%")
         self.test_ideal_network("Over 1% corrupt network")
 
     def test_duplicates_network(self):
         # reliability over network with duplicate packets
         # setup environment
-        run_command(netem_change.format("duplicate 10%"))
+        self.change_network("duplicate 10%")
         self.test_ideal_network("Over 10% duplicate network")
 
     def test_lossy_network(self):
         # reliability over network with packet loss
         # setup environment
-        run_command(netem_change.format("loss 10% 25%"))
+        self.change_network("loss 10% 25%")
         self.test_ideal_network("Over lossy network")
 
     def test_reordering_network(self):
         # reliability over network with packet reordering
         # setup environment
-        run_command(netem_change.format("delay 20ms reorder 25% 50%"))
+        self.change_network("delay 20ms reorder 25% 50%")
         self.test_ideal_network("Over delayed, reordering network")
 
     def test_delayed_network(self):
         # reliability over network with delay relative to the timeout value
         # setup environment
-        run_command(netem_change.format("delay "+str(timeout/3)+"ms 20ms"))
+        self.change_network("delay "+str(timeout/3)+"ms 20ms")
         self.test_ideal_network("Over delayed network")
     
     def test_allbad_network(self):
         # reliability over network with all of the above problems
         # setup environment
-        run_command(netem_change.format("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%"))
+        self.change_network("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%")
         self.test_ideal_network("Over all bad network")
     
+class TestEmulatedNetwork(TestbTCPFramework):
+    """The same scenarios over the in-process network emulator, which needs no root privileges"""
+
+    def setUp(self):
+        self.network = EmulatedNetwork(seed=0)
+        self.lossy_layer = self.network.layer
+        self.serv_socket = BTCPServerSocket(args.window, args.timeout, args.debug, lossy_layer=self.lossy_layer)
+        self.serv_socket.listen()
+
+    def tearDown(self):
+        self.serv_socket.close()
+        self.network.close()
+
+    def change_network(self, rule):
+        self.network.change(rule)
+
+class TestNetworkConditions(unittest.TestCase):
+    """Parsing and applying netem rules in the emulator"""
+
+    def test_parse(self):
+        conditions = NetworkConditions.parse("corrupt 1% duplicate 10% loss 10% 25% delay 20ms 5ms reorder 25% 50% rate 10mbit")
+        self.assertEqual((conditions.corrupt, conditions.duplicate), (0.01, 0.1))
+        self.assertEqual((conditions.loss, conditions.loss_correlation), (0.1, 0.25))
+        self.assertEqual((conditions.delay, conditions.jitter), (0.02, 0.005))
+        self.assertEqual((conditions.reorder, conditions.reorder_correlation), (0.25, 0.5))
+        self.assertEqual(conditions.rate, 10e6)
+        with self.assertRaises(ValueError):
+            NetworkConditions.parse("slot 10ms")
+
+    def _run(self, rule, seed):
+        conditions = NetworkConditions.parse(rule)
+        link = Link(seed)
+        return [link.transmit(bytes(100), conditions, 0) for _ in range(1000)]
+
+    def test_seeded(self):
+        rule = "corrupt 1% duplicate 10% loss 10% 25% delay 20ms 5ms reorder 25% 50%"
+        self.assertEqual(self._run(rule, 1), self._run(rule, 1))
+        self.assertNotEqual(self._run(rule, 1), self._run(rule, 2))
+        lost = sum(not delays for delays, segment in self._run("loss 10%", 1))
+        self.assertTrue(50 < lost < 150)
+
+    def test_rate(self):
+        # 100 segments of 100 bytes at 80 kbit/s take a second to transmit
+        delays = [delays[0] for delays, segment in self._run("rate 80kbit", 1)[:100]]
+        self.assertAlmostEqual(delays[-1], 1)
+
+class TestStatistics(unittest.TestCase):
+    """Counters of the sockets and connections"""
+
+    def test_counters(self):
+        network = EmulatedNetwork("loss 5% corrupt 2%", seed=3)
+        exported = []
+        client_socket, serv_socket, connection = connect(lossy_layer=network.layer)
+        client_socket.export_stats(exported.append, 0.05)
+        data = os.urandom(300 * PAYLOAD_SIZE)
+        before = client_socket.stats()
+        received = send_and_receive(client_socket, connection, data)
+        stats = client_socket.stats()
+        # Retransmissions may still arrive, so take both snapshots while no batch of segments is being handled
+        with serv_socket.ack_condition:
+            connection_stats = connection.stats()
+            server_stats = serv_socket.stats()
+        close(client_socket, serv_socket)
+        network.close()
+        self.assertEqual(received, data)
+
+        # Every data segment, the final segment, and their retransmissions
+        retransmissions = stats["retransmissions_timeout"] + stats["retransmissions_fast"]
+        self.assertEqual(stats["segments_sent"] - before["segments_sent"], 300 + 1 + retransmissions)
+        self.assertGreater(retransmissions, 0)
+        self.assertGreater(sum(stats["rtt_histogram"].values()), 0)
+        self.assertEqual(connection_stats["segments_received"] + server_stats["corrupted"], server_stats["segments_received"])
+        self.assertGreater(server_stats["corrupted"], 0)
+        self.assertGreater(connection_stats["out_of_order"], 0)
+        # The exporter stops with a final snapshot when the socket is closed
+        self.assertGreater(len(exported), 1)
+        self.assertGreater(exported[-1]["segments_sent"], stats["segments_sent"])
+
+class TestTracing(unittest.TestCase):
+    """Binary tracing of protocol events"""
+
+    def test_ring_buffer(self):
+        tracer = trace.Tracer(4)
+        for seq_n in range(6):
+            tracer.record(trace.TX, seq_n=seq_n)
+        # Only the most recent events are kept, oldest first
+        self.assertEqual([event[3] for event in tracer.events()], [2, 3, 4, 5])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.bin")
+            tracer.dump(path)
+            self.assertEqual(trace.load(path), tracer.events())
+
+    def test_concurrent_records(self):
+        tracer = trace.Tracer(1 << 14)
+        def record(port):
+            for seq_n in range(2000):
+                tracer.record(trace.TX, seq_n=seq_n, port=port)
+        threads = [threading.Thread(target=record, args=(port,)) for port in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        events = tracer.events()
+        # No event is lost or overwritten, and the events of every thread are in order
+        self.assertEqual(tracer.count, 8000)
+        for port in range(4):
+            self.assertEqual([event[3] for event in events if event[7] == port], list(range(2000)))
+        self.assertEqual([event[0] for event in events], sorted(event[0] for event in events))
+
+    def test_transfer(self):
+        network = EmulatedNetwork("loss 5%", seed=1)
+        serv_socket = BTCPServerSocket(winsize, timeout, debug, lossy_layer=network.layer)
+        serv_socket.listen()
+        server_tracer = serv_socket.enable_tracing()
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries, lossy_layer=network.layer)
+        client_tracer = client_socket.enable_tracing()
+        client_socket.connect()
+        data = os.urandom(100 * PAYLOAD_SIZE)
+        thread = threading.Thread(target=lambda: serv_socket.accept().recv())
+        thread.start()
+        client_socket.send(data)
+        thread.join()
+        client_socket.disconnect()
+        client_socket.close()
+        serv_socket.close()
+        network.close()
+
+        client_events = client_tracer.events()
+        kinds = [event[1] for event in client_events]
+        # Every data segment and the final segment are sent, and lost ones are retransmitted
+        data_sent = [event for event in client_events if event[1] == trace.TX and event[2] == 0]
+        self.assertEqual(len(data_sent), 101)
+        self.assertIn(trace.RETRANSMIT, kinds)
+        self.assertIn(trace.RX, kinds)
+        self.assertEqual(kinds[-1], trace.RESET)
+        # The client goes through all of its states, the connection through those of the server
+        self.assertEqual([event[6] for event in client_events if event[1] == trace.STATE], [1, 2, 4, 3, 0])
+        server_states = [event[6] for event in server_tracer.events() if event[1] == trace.STATE]
+        self.assertEqual(server_states[:3], [2, 3, 0])
+        self.assertEqual([event[0] for event in client_events], sorted(event[0] for event in client_events))
+
+class TestChecksum(unittest.TestCase):
+    """Checksum backends must agree bit for bit"""
+
+    def test_backends_agree(self):
+        packets = [os.urandom(random.randrange(0, 2048)) for _ in range(200)]
+        packets += [b"", b"\xff" * 1018, b"\xff" * 1017]
+        expected = [checksum.checksum_python(packet) for packet in packets]
+        self.assertEqual([checksum.checksum_numpy(packet) for packet in packets], expected)
+        self.assertEqual(checksum.checksum_batch(packets), expected)
+
+    def test_packed_segment_verifies(self):
+        for backend in ("python", "numpy"):
+            checksum.set_backend(backend)
+            segment = BTCPSegment(1234, 5678, 100, b"bTCP" * 100).pack()
+            self.assertEqual(BTCPSegment.get_checksum(segment), 0)
+        checksum.set_backend("numpy")
+
+class TestSegment(unittest.TestCase):
+    """Packing and unpacking of segments"""
+
+    def test_sack_segment(self):
+        blocks = [(5, 8), (65530, 2)]
+        segment = SACKSegment(10, 4, 100, blocks).pack()
+        self.assertEqual(BTCPSegment.get_checksum(segment), 0)
+        seq_n, ack_n, flags, window, data_length, checksum, body = BTCPSegment.unpack(segment)
+        self.assertEqual(flags, FLAG_ACK | FLAG_SACK)
+        self.assertEqual(BTCPSegment.unpack_sack_blocks(body, data_length), blocks)
+
+    def test_unpack_without_copy(self):
+        segment = BTCPSegment(1, 2, 3, b"bTCP" * 10).pack()
+        seq_n, ack_n, flags, window, data_length, checksum, body = BTCPSegment.unpack(segment)
+        self.assertEqual((seq_n, ack_n, flags, window, data_length), (1, 2, 0, 3, 40))
+        # The body is a view into the segment
+        self.assertIs(body.obj, segment)
+        self.assertEqual(bytes(body[:data_length]), b"bTCP" * 10)
+
+    def test_pack_into_reused_buffer(self):
+        buffer = bytearray(b"x" * (SEGMENT_SIZE + 4))
+        BTCPSegment(1, 2, 3, b"bTCP").pack_into(buffer, 4)
+        self.assertEqual(buffer[:4], b"xxxx")
+        self.assertEqual(buffer[4 + HEADER_SIZE + 4:], bytes(PAYLOAD_SIZE - 4))
+
+    def test_variable_length(self):
+        segment = ACKSegment(1, 2, 3)
+        short = segment.pack(varlen=True)
+        self.assertEqual(len(short), HEADER_SIZE)
+        self.assertEqual(BTCPSegment.get_checksum(short), 0)
+        # Padding does not change the checksum, so only the length differs
+        self.assertEqual(segment.pack()[:HEADER_SIZE], short)
+        self.assertEqual(len(BTCPSegment(1, 2, 3, b"bTCP").pack(varlen=True)), HEADER_SIZE + 4)
+
+    def test_payload_size_option(self):
+        segment = SYNSegment(100, payload_size=9000).pack()
+        seq_n, ack_n, flags, window, data_length, checksum, body = BTCPSegment.unpack(segment)
+        self.assertEqual(BTCPSegment.unpack_payload_size(body, data_length), 9000)
+        # Without the option, the default payload size is used
+        self.assertEqual(BTCPSegment.unpack_payload_size(body, 0), PAYLOAD_SIZE)
+
+    def test_packed_once(self):
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries, lossy_layer=CollectingLayer)
+        sent = client_socket._lossy_layer.sent
+        client_socket.start_sending(os.urandom(5 * PAYLOAD_SIZE))
+        with mock.patch.object(BTCPSegment, "pack_into", autospec=True, side_effect=BTCPSegment.pack_into) as pack_into:
+            with client_socket.mutex:
+                client_socket.pump()
+                # Every segment, including the final one, is packed once when it is produced
+                self.assertEqual(pack_into.call_count, 6)
+                first = list(sent)
+                sent.clear()
+                # Time out immediately
+                client_socket.rtt = RTTEstimator(0, minimum=0)
+                client_socket.pump()
+                self.assertEqual(pack_into.call_count, 6)
+        # The retransmissions are the stored packed segments
+        self.assertEqual(client_socket.counters.retransmissions_timeout, 6)
+        self.assertEqual(sent, first)
+        client_socket.close()
+
+class TestIterPayloads(unittest.TestCase):
+    """Splitting the source of a send into payloads"""
+
+    def test_rechunks_uneven_chunks(self):
+        payloads = list(iter_payloads([b"a" * 5, b"b" * 3, b"c" * 10], 4))
+        self.assertEqual([len(payload) for payload in payloads], [4, 4, 4, 4, 2])
+        self.assertEqual(b"".join(payloads), b"a" * 5 + b"b" * 3 + b"c" * 10)
+
+    def test_text_file(self):
+        text = "bTCP sends wörds with ünïcode\n" * 10
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "input.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            with open(path, "r", encoding="utf-8") as f:
+                payloads = list(iter_payloads(f, 16))
+        # Characters are read, but payloads are measured in encoded bytes
+        self.assertEqual(b"".join(payloads), text.encode())
+        self.assertTrue(all(len(payload) == 16 for payload in payloads[:-1]))
+
+    def test_generator(self):
+        payloads = list(iter_payloads((bytes([i]) * 3 for i in range(5)), 4))
+        self.assertEqual(payloads, [b"\x00\x00\x00\x01", b"\x01\x01\x02\x02", b"\x02\x03\x03\x03", b"\x04\x04\x04"])
+
+    def test_empty(self):
+        for source in (b"", [], iter(())):
+            self.assertEqual(list(iter_payloads(source, 4)), [])
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(list(iter_payloads(f, 4)), [])
+
+# Connect a client to a new server, and return the client socket, the server socket and the connection.
+# The keyword arguments are passed to both sockets, and `client_kwargs` and `server_kwargs` to only one of them.
+def connect(client_kwargs = {}, server_kwargs = {}, **socket_kwargs):
+    serv_socket = BTCPServerSocket(winsize, timeout, debug, **socket_kwargs, **server_kwargs)
+    serv_socket.listen()
+    client_socket = BTCPClientSocket(winsize, timeout, debug, retries, **socket_kwargs, **client_kwargs)
+    client_socket.connect()
+    return client_socket, serv_socket, serv_socket.accept(timeout=5)
+
+# Send `data` from the client, while the connection receives it in another thread, and return the received data
+def send_and_receive(client_socket, connection, data):
+    received = bytearray()
+    def receive():
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            received.extend(chunk)
+    thread = threading.Thread(target=receive)
+    thread.start()
+    client_socket.send(data)
+    thread.join()
+    return bytes(received)
+
+# Disconnect the client, and close both sockets
+def close(client_socket, serv_socket):
+    client_socket.disconnect()
+    client_socket.close()
+    serv_socket.close()
+
+# Transfer `data` over a new connection, with the arguments of connect. Returns the client socket, the server socket,
+# the connection and the received data, such that the state of the connection can be inspected before closing it.
+def transfer(data, client_kwargs = {}, server_kwargs = {}, **socket_kwargs):
+    client_socket, serv_socket, connection = connect(client_kwargs, server_kwargs, **socket_kwargs)
+    return client_socket, serv_socket, connection, send_and_receive(client_socket, connection, data)
+
+# Does not send anything, but collects the unpacked segments that would be sent, for tests that hand segments
+# to a socket directly
+class CollectingLayer:
+    def __init__(self, bTCP_sock, *addresses):
+        self.sent = []
+
+    def send_segment(self, segment, address = None):
+        self.sent.append(BTCPSegment.unpack(bytes(segment)))
+
+    def send_segments(self, segments, address = None):
+        for segment in segments:
+            self.send_segment(segment, address)
+
+    def destroy(self):
+        pass
+
+# Records the lengths of all datagrams that are sent
+class RecordingLayer(LossyLayer):
+    def __init__(self, *args):
+        self.sizes = []
+        super().__init__(*args)
+
+    def send_segment(self, segment, address = None):
+        self.sizes.append(len(segment))
+        super().send_segment(segment, address)
+
+    def send_segments(self, segments, address = None):
+        self.sizes.extend(len(segment) for segment in segments)
+        super().send_segments(segments, address)
+
+class TestDelayedAcks(unittest.TestCase):
+    """Delayed and cumulative ACKs of the server"""
+
+    def setUp(self):
+        self.serv_socket = BTCPServerSocket(winsize, timeout, debug, lossy_layer=CollectingLayer, ack_every=2, ack_delay=50)
+        self.serv_socket.listen()
+        self.address = ("127.0.0.1", 1)
+        syn = SYNSegment(winsize)
+        self.isn = seq_add(syn.seq_n, 1)
+        self.input(syn)
+        self.input(ACKSegment(self.isn, 0, winsize))
+        self.sent = self.serv_socket._lossy_layer.sent
+        self.sent.clear()
+
+    def tearDown(self):
+        self.serv_socket.close()
+
+    # Hand segments to the server as a single batch
+    def input(self, *segments):
+        self.serv_socket.lossy_layer_input_batch([(segment.pack(), self.address) for segment in segments])
+
+    def data(self, *indices):
+        return [BTCPSegment(seq_add(self.isn, i), 0, winsize, b"bTCP") for i in indices]
+
+    # The ack_n of the segments sent by the server
+    @property
+    def acks(self):
+        return [segment[1] for segment in self.sent]
+
+    def test_ack_every_other_segment(self):
+        self.input(*self.data(0, 1, 2, 3))
+        self.assertEqual(self.acks, [seq_add(self.isn, 2), seq_add(self.isn, 4)])
+        # A single segment is acknowledged once the delay has passed
+        self.input(*self.data(4))
+        self.assertEqual(len(self.acks), 2)
+        time.sleep(0.2)
+        self.assertEqual(self.acks[2:], [seq_add(self.isn, 5)])
+
+    def test_immediate_ack_on_gap(self):
+        self.input(*self.data(0))
+        # Segment 1 is missing, so every later segment is acknowledged immediately with a duplicate ACK
+        self.input(*self.data(2))
+        self.input(*self.data(3))
+        self.assertEqual(self.acks, [seq_add(self.isn, 1)] * 2)
+        # Filling the gap is acknowledged immediately as well
+        self.input(*self.data(1))
+        self.assertEqual(self.acks[2:], [seq_add(self.isn, 4)])
+
+class TestSendLoop(unittest.TestCase):
+    """Blocking of the client send loop"""
+
+    def test_stalled_send_does_not_spin(self):
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries, lossy_layer=CollectingLayer)
+        # Pretend to be connected to a server whose window is full, and which never acknowledges anything
+        client_socket.state = 2
+        client_socket.receive_window = 0
+        with mock.patch.object(client_socket, "pump", wraps=client_socket.pump) as pump:
+            thread = threading.Thread(target=client_socket.send, args=(os.urandom(3 * PAYLOAD_SIZE),))
+            thread.start()
+            time.sleep(1)
+            # The loop only wakes up for the retransmission timer, which fires at most a few times per second
+            self.assertLessEqual(pump.call_count, 1 + 1000 // timeout)
+            # End the send as if the final segment was acknowledged
+            with client_socket.mutex:
+                client_socket.last_acked = -1
+                client_socket.mutex.notify_all()
+            thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        client_socket.close()
+
+    def test_zero_window_probe(self):
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries, lossy_layer=CollectingLayer)
+        sent = client_socket._lossy_layer.sent
+        client_socket.receive_window = 0
+        client_socket.start_sending(os.urandom(3 * PAYLOAD_SIZE))
+        with client_socket.mutex:
+            # With a window of 0, only a single segment is sent
+            client_socket.pump()
+            self.assertEqual([segment[0] for segment in sent], [0])
+            cwnd = client_socket.congestion_window()
+            # Time out immediately, while the window is still closed
+            client_socket.rtt = RTTEstimator(0, minimum=0)
+            with mock.patch.object(client_socket.rtt, "backoff") as backoff:
+                client_socket.pump()
+        # The segment is resent as a window probe, which is not treated as a loss
+        self.assertEqual([segment[0] for segment in sent], [0, 0])
+        self.assertEqual(client_socket.counters.window_probes, 1)
+        self.assertEqual(client_socket.counters.retransmissions_timeout, 0)
+        self.assertEqual(client_socket.congestion_window(), cwnd)
+        backoff.assert_not_called()
+        client_socket.close()
+
+class TestSelectiveRetransmission(unittest.TestCase):
+    """Retransmission of only the segments that SACK blocks show to be missing"""
+
+    def test_retransmits_only_missing_segments(self):
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries, lossy_layer=CollectingLayer)
+        client_socket.sack_enabled = True
+        segments = client_socket._lossy_layer.sent
+        client_socket.start_sending(os.urandom(50 * PAYLOAD_SIZE))
+        # The sequence numbers start at 0, as the socket is not connected
+        def ack(blocks):
+            segment = SACKSegment(0, 1, winsize, blocks)
+            client_socket.handle_ack(segment.ack_n, True, segment.data, segment.data_length)
+        with client_socket.mutex:
+            client_socket.pump()
+            self.assertEqual([segment[0] for segment in segments], list(range(INITIAL_CWND)))
+            segments.clear()
+            # Segments 1 and 4 are lost, and the server reports every later segment it receives
+            ack([])
+            for received in (2, 3, 5, 6, 7, 8, 9):
+                ack([(start, min(end, received + 1)) for start, end in ((2, 4), (5, 10)) if start <= received])
+            client_socket.pump()
+        # Only the missing segments are retransmitted, not the ones in the SACK blocks
+        self.assertEqual([segment[0] for segment in segments if segment[0] < INITIAL_CWND], [1, 4])
+        self.assertEqual(client_socket.counters.retransmissions_fast, 2)
+        self.assertEqual(client_socket.counters.retransmissions_timeout, 0)
+        client_socket.close()
+
+class TestFastRecovery(unittest.TestCase):
+    """Fast retransmit and recovery of the client"""
+
+    def test_retransmits_only_lost_segment(self):
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries, sack=False, lossy_layer=CollectingLayer)
+        segments = client_socket._lossy_layer.sent
+        # The seq_n of the segments sent by the client
+        sent = lambda: [segment[0] for segment in segments]
+        client_socket.start_sending(os.urandom(50 * PAYLOAD_SIZE))
+        ack = lambda index: client_socket.handle_ack(seq_add(client_socket.isn, index), False, b"", 0)
+        with client_socket.mutex:
+            client_socket.pump()
+            self.assertEqual(sent(), list(range(INITIAL_CWND)))
+            # Segment 1 is lost, every later segment results in a duplicate ACK
+            ack(1)
+            client_socket.pump()
+            segments.clear()
+            for _ in range(3):
+                ack(1)
+            client_socket.pump()
+            # Only the lost segment is retransmitted, the rest stays in flight
+            self.assertEqual(sent(), [1])
+            self.assertEqual(client_socket.counters.retransmissions_fast, 1)
+            window = client_socket.congestion.window
+            # Every further duplicate ACK inflates the window by a segment, such that new segments are sent
+            segments.clear()
+            for _ in range(window):
+                ack(1)
+            client_socket.pump()
+            self.assertGreater(len(segments), 0)
+            self.assertNotIn(1, sent())
+            self.assertEqual(client_socket.congestion_window(), window + 3 + window)
+            # Once the retransmission is acknowledged, the window deflates again
+            ack(client_socket.last_sent)
+            self.assertEqual(client_socket.congestion_window(), client_socket.congestion.window)
+        client_socket.close()
+
+class TestTimerQueue(unittest.TestCase):
+    """Timers of retransmissions and delayed ACKs"""
+
+    def test_arm_cancel_expire(self):
+        timers = TimerQueue()
+        for key in range(3):
+            timers.arm(key, key)
+        # Rearming moves a timer to the back
+        timers.arm(0, 5)
+        timers.cancel(1)
+        self.assertEqual(timers.first(), (2, 2))
+        self.assertEqual(timers.pop_expired(5.5, 1), [2])
+        self.assertEqual(timers.remaining(0, 5.5, 1), 0.5)
+        self.assertEqual(timers.pop_expired(6, 1), [0])
+        self.assertIsNone(timers.first())
+
+    def test_handshakes_do_not_wait_for_timeout(self):
+        serv_socket = BTCPServerSocket(winsize, timeout, debug)
+        serv_socket.listen()
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries)
+        start = time.time()
+        client_socket.connect()
+        serv_socket.accept(timeout=5)
+        client_socket.disconnect()
+        # Both the SYN and the FIN are answered immediately
+        self.assertLess(time.time() - start, timeout / 1000)
+        self.assertEqual(len(client_socket.timers), 0)
+        client_socket.close()
+        serv_socket.close()
+
+class TestVariableLength(unittest.TestCase):
+    """Negotiation of segments without padding"""
+
+    def transfer(self, client_varlen, server_varlen):
+        data = os.urandom(50 * PAYLOAD_SIZE + 17)
+        client_socket, serv_socket, connection, received = transfer(data, {"varlen": client_varlen}, {"varlen": server_varlen},
+                                                                    lossy_layer=RecordingLayer)
+        enabled = (client_socket.varlen_enabled, connection.varlen_enabled)
+        client_sizes, server_sizes = client_socket._lossy_layer.sizes, serv_socket._lossy_layer.sizes
+        close(client_socket, serv_socket)
+        self.assertEqual(received, data)
+        return enabled, client_sizes, server_sizes
+
+    def test_negotiated(self):
+        enabled, client_sizes, server_sizes = self.transfer(True, True)
+        self.assertEqual(enabled, (True, True))
+        # Only the SYN is padded, the ACKs, the final data segment and the final segment are short
+        self.assertEqual(client_sizes[0], SEGMENT_SIZE)
+        self.assertIn(HEADER_SIZE + 17, client_sizes)
+        self.assertIn(HEADER_SIZE, client_sizes)
+        self.assertTrue(all(size < SEGMENT_SIZE for size in server_sizes))
+
+    def test_not_supported(self):
+        for client_varlen, server_varlen in ((True, False), (False, True)):
+            enabled, client_sizes, server_sizes = self.transfer(client_varlen, server_varlen)
+            self.assertEqual(enabled, (False, False))
+            self.assertEqual(set(client_sizes + server_sizes), {SEGMENT_SIZE})
+
+class TestPayloadSize(unittest.TestCase):
+    """Negotiation of the payload size"""
+
+    def test_negotiated(self):
+        client_socket, serv_socket, connection = connect({"payload_size": 9000}, {"payload_size": 16000})
+        tracer = client_socket.enable_tracing()
+        # The smallest of both sizes is used
+        self.assertEqual((client_socket.payload_size, connection.payload_size), (9000, 9000))
+        data = os.urandom(100 * 9000 + 17)
+        received = send_and_receive(client_socket, connection, data)
+        close(client_socket, serv_socket)
+        self.assertEqual(received, data)
+        # The data segments carry at most the negotiated payload size
+        self.assertEqual(max(event[6] for event in tracer.events() if event[1] == trace.TX and event[2] == 0 and event[6] != 65534), 9000)
+        # The buffer of the server holds a window of such segments
+        self.assertEqual(connection.buffer.capacity, winsize * 9000)
+
+    def test_out_of_range(self):
+        for payload_size in (0, MIN_PAYLOAD_SIZE - 1, MAX_PAYLOAD_SIZE + 1):
+            with self.assertRaises(ValueError):
+                BTCPServerSocket(winsize, timeout, debug, payload_size=payload_size)
+            with self.assertRaises(ValueError):
+                BTCPClientSocket(winsize, timeout, debug, retries, payload_size=payload_size)
+        serv_socket = BTCPServerSocket(winsize, timeout, debug)
+        serv_socket.listen()
+        client_socket = BTCPClientSocket(winsize, timeout, debug, retries)
+        # A misbehaving client advertises a payload size of 0, which the server raises to the minimum
+        client_socket.max_payload_size = 0
+        client_socket.connect()
+        connection = serv_socket.accept(timeout=5)
+        self.assertEqual(connection.payload_size, MIN_PAYLOAD_SIZE)
+        client_socket.payload_size = MIN_PAYLOAD_SIZE
+        data = os.urandom(10 * MIN_PAYLOAD_SIZE)
+        client_socket.send(data)
+        self.assertEqual(connection.recv(len(data), timeout=5), data)
+        client_socket.disconnect()
+        client_socket.close()
+        serv_socket.close()
+
+    def test_probe(self):
+        size = probe_payload_size("127.0.0.1")
+        self.assertGreaterEqual(size, PAYLOAD_SIZE)
+        self.assertLessEqual(size, MAX_PAYLOAD_SIZE)
+
+class TestSequenceNumbers(unittest.TestCase):
+    """Serial number arithmetic on 16 bit sequence numbers"""
+
+    def test_wraparound(self):
+        self.assertEqual(seq_add(65535, 1), 0)
+        self.assertEqual(seq_add(65530, 10), 4)
+        self.assertEqual(seq_distance(65530, 4), 10)
+        self.assertEqual(seq_diff(65530, 4), 10)
+        self.assertEqual(seq_diff(4, 65530), -10)
+        self.assertEqual(seq_diff(100, 100), 0)
+
+    def test_transfer_across_wraparound(self):
+        """a transfer whose sequence numbers wrap around"""
+        data = os.urandom(200 * 1008 + 17)
+        # Start close to the end of the sequence space
+        with mock.patch.object(random, "randrange", return_value=65500):
+            client_socket, serv_socket, connection, received = transfer(data)
+        self.assertEqual(client_socket.isn, 65501)
+        close(client_socket, serv_socket)
+        self.assertEqual(received, data)
+
+class TestRTTEstimator(unittest.TestCase):
+    """Adaptive retransmission timeout"""
+
+    def test_converges_and_backs_off(self):
+        estimator = RTTEstimator(0.3, minimum=0.001)
+        self.assertEqual(estimator.rto, 0.3)
+        for _ in range(50):
+            estimator.sample(0.01)
+        self.assertAlmostEqual(estimator.srtt, 0.01)
+        self.assertLess(estimator.rto, 0.02)
+        rto = estimator.rto
+        estimator.backoff()
+        estimator.backoff()
+        self.assertAlmostEqual(estimator.rto, rto * 4)
+
+    def test_bounds(self):
+        estimator = RTTEstimator(0.3, minimum=0.05, maximum=1)
+        estimator.sample(0.001)
+        self.assertEqual(estimator.rto, 0.05)
+        for _ in range(10):
+            estimator.backoff()
+        self.assertEqual(estimator.rto, 1)
+
+class TestCongestionControl(unittest.TestCase):
+    """Congestion window evolution"""
+
+    def test_reno(self):
+        reno = congestion.create("reno", 100)
+        reno.on_ack(10, 0, 0.01)
+        self.assertEqual(reno.cwnd, 20)
+        reno.on_loss(0, 20)
+        self.assertEqual((reno.cwnd, reno.ssthresh), (10, 10))
+        # Congestion avoidance grows by about one segment per window of ACKs
+        reno.on_ack(10, 0, 0.01)
+        self.assertAlmostEqual(reno.cwnd, 11)
+        reno.on_timeout(0, 11)
+        self.assertEqual((reno.cwnd, reno.ssthresh), (1, 5.5))
+        # The history is only kept once enabled
+        self.assertIsNone(reno.history)
+        reno.enable_history(1)
+        reno.on_ack(1, 2, 0.01)
+        self.assertEqual(reno.history, [(1, 1, 5.5), (2, 2, 5.5)])
+
+    def test_cubic_recovers_to_w_max(self):
+        cubic = congestion.create("cubic", 255)
+        cubic.enable_history(0)
+        cubic.on_ack(40, 0, 0.01)
+        cubic.on_loss(0, 50)
+        self.assertAlmostEqual(cubic.cwnd, 35)
+        # After K seconds, the cubic function is back at the window where the loss occurred
+        now = 0
+        while now < cubic.k:
+            now += 0.01
+            cubic.on_ack(1, now, 0.01)
+        self.assertGreater(cubic.cwnd, 45)
+        self.assertLessEqual(max(cwnd for _, cwnd, _ in cubic.history), 255)
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            congestion.create("vegas", 100)
+        # The base class only provides what the algorithms have in common
+        with self.assertRaises(TypeError):
+            congestion.CongestionControl(100)
+
+class TestServerRecv(unittest.TestCase):
+    """Blocking reads from the server socket"""
+
+    def setUp(self):
+        self.serv_socket = BTCPServerSocket(winsize, timeout, False)
+        self.connection = BTCPServerConnection(self.serv_socket, ("127.0.0.1", 1))
+
+    def tearDown(self):
+        self.serv_socket.close()
+
+    def test_recv_and_eof(self):
+        with self.assertRaises(TimeoutError):
+            self.connection.recv(timeout=0.01)
+        self.connection.deliver(0, 3, b"abc")
+        self.connection.deliver(1, 4, b"defg")
+        self.assertEqual(self.connection.recv(5), b"abcde")
+        buffer = bytearray(10)
+        self.assertEqual(self.connection.recv_into(buffer), 2)
+        self.assertEqual(buffer[:2], b"fg")
+        # Deliver the final segment from another thread while recv is waiting
+        threading.Timer(0.05, self.connection.deliver, (2, 65534, b"")).start()
+        self.assertEqual(self.connection.recv(timeout=5), b"")
+        self.assertEqual(self.connection.recv_into(buffer), 0)
+
+    def test_recv_file_timeout(self):
+        self.connection.deliver(0, 3, b"abc")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "output")
+            with self.assertRaises(TimeoutError):
+                self.connection.recv_file(path, mmap.ALLOCATIONGRANULARITY, timeout=0.01)
+            # The data received so far is kept, without the preallocated space
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"abc")
+
+    def test_ring_buffer_wraps(self):
+        buffer = RingBuffer(8)
+        buffer.write(b"abcdef")
+        self.assertEqual(buffer.read(4), b"abcd")
+        buffer.write(b"ghijkl")
+        self.assertEqual(buffer.free, 0)
+        with self.assertRaises(BufferError):
+            buffer.write(b"m")
+        view = memoryview(bytearray(8))
+        self.assertEqual(buffer.read_into(view, 8), 8)
+        self.assertEqual(view.tobytes(), b"efghijkl")
+        self.assertEqual(len(buffer), 0)
+        # Reads that wrap around the end of the buffer
+        buffer.write(b"abcdef")
+        buffer.read(4)
+        buffer.write(b"ghijkl")
+        self.assertEqual(buffer.read(7), b"efghijk")
+        self.assertEqual(buffer.read(7), b"l")
+
+    def test_window_counts_bytes(self):
+        self.connection.deliver(0, 3, b"abc")
+        # A partially filled segment still takes up a full segment of the window
+        self.assertEqual(self.connection.free_segments(), winsize - 1)
+        self.connection.recv(3)
+        self.assertEqual(self.connection.free_segments(), winsize)
+
+    def test_drops_when_window_full(self):
+        self.serv_socket.ack_every = 1
+        self.connection.state = 3
+        self.connection.last_sent_ack_n = 0
+        for seq_n in range(winsize):
+            self.connection.handle_segment(seq_n, 0, 0, 0, PAYLOAD_SIZE, bytes(PAYLOAD_SIZE))
+        self.assertEqual(self.connection.free_segments(), 0)
+        # The expected segment does not fit, and neither does one ahead of it
+        self.connection.handle_segment(winsize, 0, 0, 0, PAYLOAD_SIZE, bytes(PAYLOAD_SIZE))
+        self.connection.handle_segment(winsize + 1, 0, 0, 0, PAYLOAD_SIZE, bytes(PAYLOAD_SIZE))
+        stats = self.connection.stats()
+        self.assertEqual((stats["window_drops"], stats["out_of_order_drops"], stats["out_of_order"]), (1, 1, 0))
+
+    def test_window_update(self):
+        self.serv_socket.ack_every = 1
+        self.connection.state = 3
+        self.connection.last_sent_ack_n = 0
+        for seq_n in range(winsize):
+            self.connection.handle_segment(seq_n, 0, 0, 0, PAYLOAD_SIZE, bytes(PAYLOAD_SIZE))
+        self.assertEqual(self.connection.last_ack.window, 0)
+        # Reading makes room for a segment, which the client is told about without having to probe
+        with mock.patch.object(self.connection, "send_ack", wraps=self.connection.send_ack) as send_ack:
+            self.connection.recv(PAYLOAD_SIZE // 2)
+            send_ack.assert_not_called()
+            self.connection.recv_into(bytearray(PAYLOAD_SIZE))
+            send_ack.assert_called_once()
+        self.assertEqual(self.connection.last_ack.window, 1)
+        # Once the window is open, reading does not send any more ACKs
+        with mock.patch.object(self.connection, "send_ack") as send_ack:
+            self.connection.recv(PAYLOAD_SIZE)
+            send_ack.assert_not_called()
+
+    def test_accept_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.serv_socket.accept(timeout=0.01)
+
+class TestFileTransfer(unittest.TestCase):
+    """Memory-mapped sending and preallocated receiving of files"""
+
+    def transfer(self, data, chunk_size):
+        client_socket, serv_socket, connection = connect()
+        with tempfile.TemporaryDirectory() as directory:
+            source, output = os.path.join(directory, "input"), os.path.join(directory, "output")
+            with open(source, "wb") as f:
+                f.write(data)
+            results = []
+            thread = threading.Thread(target=lambda: results.append(connection.recv_file(output, chunk_size, timeout=10)))
+            thread.start()
+            client_socket.send_file(source)
+            thread.join()
+            with open(output, "rb") as f:
+                received = f.read()
+        close(client_socket, serv_socket)
+        self.assertEqual(results, [len(data)])
+        self.assertEqual(received, data)
+
+    def test_binary_file(self):
+        # Not valid UTF-8, and spanning several chunks of the output file
+        self.transfer(os.urandom(3 * mmap.ALLOCATIONGRANULARITY + 17) + b"\xff\xfe\x00", mmap.ALLOCATIONGRANULARITY)
+
+    def test_empty_file(self):
+        self.transfer(b"", mmap.ALLOCATIONGRANULARITY)
+
+    def test_send_without_connection(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"abc")
+            f.flush()
+            # The error is raised, rather than that closing the memory map fails
+            with self.assertRaisesRegex(Exception, "Not Connected"):
+                BTCPClientSocket(winsize, timeout, debug, retries).send_file(f.name)
+
+class TestBatchedIO(unittest.TestCase):
+    """Batched sending and receiving of datagrams"""
+
+    class Collector:
+        def __init__(self):
+            self.segments = []
+            self.batches = 0
+
+        def lossy_layer_input_batch(self, segments):
+            self.batches += 1
+            self.segments += [segment_data for segment_data, address in segments]
+
+    def _send_and_receive(self, gso, n):
+        receiver = self.Collector()
+        receiving_layer = LossyLayer(receiver, "127.0.0.1", 31500, "127.0.0.1", 31501)
+        sending_layer = LossyLayer(self.Collector(), "127.0.0.1", 31501, "127.0.0.1", 31500)
+        sending_layer._gso = sending_layer._gso and gso
+        # Runs of equally sized segments, and a shorter one in between
+        segments = [os.urandom(1018) for _ in range(n)] + [b"short"] + [os.urandom(1018) for _ in range(10)]
+        sending_layer.send_segments([memoryview(segment) for segment in segments])
+        deadline = time.time() + 5
+        while len(receiver.segments) < len(segments) and time.time() < deadline:
+            time.sleep(0.01)
+        sending_layer.destroy()
+        receiving_layer.destroy()
+        self.assertEqual(receiver.segments, segments)
+        self.assertLess(receiver.batches, len(segments))
+
+    def test_segmentation_offload(self):
+        # More than the 64 segments the kernel accepts in a single call
+        self._send_and_receive(gso=True, n=150)
+
+    def test_fallback(self):
+        # Without offloading, a large burst may overflow the receive buffer of the socket
+        self._send_and_receive(gso=False, n=40)
+
+    def test_probe_segmentation_offload(self):
+        # Platforms that do not know the socket option may also silently ignore the control message
+        setsockopt = socket.socket.setsockopt
+        def reject_segment(sock, level, option, value):
+            if (level, option) == (lossy_layer.SOL_UDP, lossy_layer.UDP_SEGMENT):
+                raise OSError("Protocol not available")
+            return setsockopt(sock, level, option, value)
+        with mock.patch.object(socket.socket, "setsockopt", reject_segment):
+            layer = LossyLayer(self.Collector(), "127.0.0.1", 31502, "127.0.0.1", 31503)
+        layer.destroy()
+        self.assertFalse(layer._gso)
+
+class TestMultipleClients(unittest.TestCase):
+    """Concurrent clients of a single server socket"""
+
+    def test_concurrent_clients(self):
+        serv_socket = BTCPServerSocket(winsize, timeout, debug)
+        serv_socket.listen()
+        data = [os.urandom(random.randrange(20000, 100000)) for _ in range(8)]
+        received = {}
+
+        def receive():
+            connection = serv_socket.accept(timeout=10)
+            chunks = bytearray()
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                chunks += chunk
+            received[connection.address] = bytes(chunks)
+
+        def send(payload):
+            client_socket = BTCPClientSocket(winsize, timeout, debug, retries)
+            client_socket.connect()
+            client_socket.send(payload)
+            client_socket.disconnect()
+            client_socket.close()
+
+        threads = [threading.Thread(target=receive) for _ in data] + [threading.Thread(target=send, args=(payload,)) for payload in data]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        serv_socket.close()
+        self.assertEqual(sorted(received.values()), sorted(data))
+
+class TestAsyncio(unittest.TestCase):
+    """Many connections driven from a single event loop"""
+
+    async def _send(self, server_addr, data):
+        client_socket = AsyncBTCPClientSocket(winsize, timeout, debug, retries, remote_addr=server_addr)
+        await client_socket.connect()
+        await client_socket.send(data)
+        await client_socket.disconnect()
+        await client_socket.close()
+
+    async def _receive(self, serv_socket):
+        connection = await serv_socket.accept(timeout=10)
+        received = bytearray()
+        while True:
+            chunk = await connection.recv(65536)
+            if not chunk:
+                return bytes(received)
+            received += chunk
+
+    def test_concurrent_connections(self):
+        server_addr = ("127.0.0.1", 31000)
+        data = [os.urandom(50000) for _ in range(20)]
+        async def main():
+            serv_socket = AsyncBTCPServerSocket(winsize, timeout, debug, local_addr=server_addr)
+            await serv_socket.listen()
+            receivers = [asyncio.create_task(self._receive(serv_socket)) for _ in data]
+            await asyncio.gather(*(self._send(server_addr, payload) for payload in data))
+            received = await asyncio.gather(*receivers)
+            await serv_socket.close()
+            return received
+        self.assertEqual(sorted(asyncio.run(main())), sorted(data))
+
+    def test_file_transfer(self):
+        server_addr = ("127.0.0.1", 31001)
+        data = os.urandom(2 * mmap.ALLOCATIONGRANULARITY + 17)
+        async def main(directory):
+            source, output = os.path.join(directory, "input"), os.path.join(directory, "output")
+            with open(source, "wb") as f:
+                f.write(data)
+            serv_socket = AsyncBTCPServerSocket(winsize, timeout, debug, local_addr=server_addr)
+            await serv_socket.listen()
+            client_socket = AsyncBTCPClientSocket(winsize, timeout, debug, retries, remote_addr=server_addr)
+            await client_socket.connect()
+            connection = await serv_socket.accept(timeout=10)
+            receiver = asyncio.create_task(connection.recv_file(output, mmap.ALLOCATIONGRANULARITY, timeout=10))
+            await client_socket.send_file(source)
+            size = await receiver
+            await client_socket.disconnect()
+            await client_socket.close()
+            await serv_socket.close()
+            with open(output, "rb") as f:
+                return size, f.read()
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(asyncio.run(main(directory)), (len(data), data))
+
 if __name__ == "__main__":
     # Parse command line arguments
     import argparse
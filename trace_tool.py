@@ -0,0 +1,106 @@
+#!/usr/local/bin/python3
+# ------------------------
+# Tom Aarsen   - s1027401
+# Bart Janssen - s4630270
+# ------------------------
+
+import argparse, csv, sys
+from btcp import trace
+from btcp.constants import *
+from btcp.sequence import SEQUENCE_SPACE, HALF_SEQUENCE_SPACE
+
+# Turns a trace written with --trace by the client or server app into a timeline, a CSV file,
+# or a plot of the sequence numbers over time.
+
+FLAG_NAMES = ((FLAG_SYN, "SYN"), (FLAG_ACK, "ACK"), (FLAG_FIN, "FIN"), (FLAG_SACK, "SACK"), (FLAG_VARLEN, "VARLEN"))
+FIELDS = ("time", "event", "flags", "seq_n", "ack_n", "window", "length", "port")
+
+def format_flags(flags):
+    return "|".join(name for flag, name in FLAG_NAMES if flags & flag) or "-"
+
+# The events with times relative to the first event, and names for the event types and flags
+def rows(events):
+    start = events[0][0] if events else 0
+    for timestamp, event, flags, seq_n, ack_n, window, length, port in events:
+        yield (f"{timestamp - start:.6f}", trace.EVENT_NAMES.get(event, str(event)), format_flags(flags),
+               seq_n, ack_n, window, length, port)
+
+def timeline(args):
+    for time, event, flags, seq_n, ack_n, window, length, port in rows(trace.load(args.trace)):
+        print(f"{time:>12} {event:<10} {flags:<16} seq={seq_n:<5} ack={ack_n:<5} win={window:<3} len={length:<5} port={port}")
+
+def to_csv(args):
+    with open(args.output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        writer.writerows(rows(trace.load(args.trace)))
+
+# Plot the sequence numbers of transmitted and retransmitted data segments, and the acknowledged
+# sequence numbers, over time. The 16 bit sequence numbers are unwrapped, such that they keep increasing.
+def plot(args):
+    try:
+        import matplotlib
+        if args.output:
+            matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        sys.exit("Plotting requires matplotlib, install it with `pip install matplotlib`")
+
+    events = trace.load(args.trace)
+    if not events:
+        sys.exit(f"{args.trace} holds no events")
+    start = events[0][0]
+    series = {"sent": ([], []), "retransmitted": ([], []), "acknowledged": ([], [])}
+    for timestamp, event, flags, seq_n, ack_n, window, length, port in events:
+        if event in (trace.TX, trace.RETRANSMIT) and not flags & (FLAG_SYN | FLAG_ACK | FLAG_FIN):
+            name, number = ("sent" if event == trace.TX else "retransmitted"), seq_n
+        elif event == trace.RX and flags & FLAG_ACK and not flags & (FLAG_SYN | FLAG_FIN):
+            name, number = "acknowledged", ack_n
+        else:
+            continue
+        times, numbers = series[name]
+        times.append(timestamp - start)
+        numbers.append(number)
+
+    # Unwrap every series separately, as consecutive values are always close together
+    for times, numbers in series.values():
+        offset = 0
+        for i in range(1, len(numbers)):
+            if numbers[i] + offset < numbers[i - 1] - HALF_SEQUENCE_SPACE:
+                offset += SEQUENCE_SPACE
+            numbers[i] += offset
+
+    fig, ax = plt.subplots()
+    for (name, (times, numbers)), marker in zip(series.items(), ("b.", "rx", "g.")):
+        ax.plot(times, numbers, marker, markersize=3, label=name)
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Sequence number")
+    ax.legend()
+    if args.output:
+        fig.savefig(args.output)
+    else:
+        plt.show()
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect bTCP traces")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_timeline = subparsers.add_parser("timeline", help="Print the events in chronological order")
+    parser_timeline.add_argument("trace", help="Trace file")
+    parser_timeline.set_defaults(func=timeline)
+
+    parser_csv = subparsers.add_parser("csv", help="Convert the events to CSV")
+    parser_csv.add_argument("trace", help="Trace file")
+    parser_csv.add_argument("-o", "--output", help="CSV file to write the events to", required=True)
+    parser_csv.set_defaults(func=to_csv)
+
+    parser_plot = subparsers.add_parser("plot", help="Plot the sequence numbers over time, requires matplotlib")
+    parser_plot.add_argument("trace", help="Trace file")
+    parser_plot.add_argument("-o", "--output", help="Image file to write the plot to, instead of showing it", default=None)
+    parser_plot.set_defaults(func=plot)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+main()